@@ -0,0 +1,642 @@
+#!/usr/bin/env python3
+"""
+Offline end-to-end benchmark for the YouTube Downloader Bot
+
+Everything runs locally, no network needed:
+- a media server streaming synthetic audio/video files
+- a stub yt-dlp extractor that answers for YouTube URLs with formats on that server
+- a fake Bot API that accepts uploads and records when each byte arrived
+
+Simulated users send URLs and press the buttons like real ones, through the
+bot's own handlers, scheduler and downloader. The report shows p50/p95
+time-to-first-byte (download chosen -> first upload byte at the Bot API),
+time-to-delivery (-> last file received), jobs per minute, CPU time, peak
+RSS, peak disk use and how long a fresh process takes to import and set
+up the bot. Save it with --json to compare commits.
+
+Usage:
+    python benchmark.py --users 20 --playlists 2 --json bench.json
+
+Bot settings (MAX_CONCURRENT_JOBS, DOWNLOAD_WORKERS, ...) are read from the
+environment as usual. The media is synthetic, so audio is kept in its
+source format (AUDIO_OUTPUT_FORMAT=native) and nothing is re-encoded.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+CHUNK_SIZE = 64 * 1024
+TERMINAL_MARKS = ('✅', '❌', '🚦', '🚫')
+
+
+# --- Local media server -------------------------------------------------------
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Serves /media/<name>?size=<bytes> as a stream of synthetic bytes"""
+
+    bandwidth = 0  # Bytes per second per connection, 0 for unlimited
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        if not parsed.path.startswith('/media/'):
+            self.send_error(404)
+            return
+
+        size = int(urllib.parse.parse_qs(parsed.query).get('size', ['0'])[0])
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        chunk = b'\0' * CHUNK_SIZE
+        remaining = end - start + 1
+        started = time.monotonic()
+        sent = 0
+        try:
+            while remaining > 0:
+                n = min(CHUNK_SIZE, remaining)
+                self.wfile.write(chunk[:n])
+                remaining -= n
+                sent += n
+                if self.bandwidth:
+                    ahead = sent / self.bandwidth - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The download was cancelled
+
+
+# --- Fake Bot API -------------------------------------------------------------
+
+class BotAPIHandler(BaseHTTPRequestHandler):
+    """Answers Bot API calls like Telegram would and records every call as an event.
+
+    GET /events?since=N returns the events from index N on, so the benchmark
+    in the other process can follow the conversation.
+    """
+
+    events = []
+    lock = threading.Lock()
+    message_ids = {}  # chat_id -> last message_id handed out
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        if parsed.path != '/events':
+            self.send_error(404)
+            return
+        since = int(urllib.parse.parse_qs(parsed.query).get('since', ['0'])[0])
+        with self.lock:
+            self._reply(self.events[since:])
+
+    def _read_body(self):
+        """Read the request body; returns (body, time the first byte arrived)"""
+        length = int(self.headers.get('Content-Length', 0))
+        chunks, first_byte = [], None
+        while length > 0:
+            chunk = self.rfile.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            if first_byte is None:
+                first_byte = time.time()
+            chunks.append(chunk)
+            length -= len(chunk)
+        return b''.join(chunks), first_byte or time.time()
+
+    def _parse_params(self, body):
+        """Form fields of the call; uploaded files are reduced to their size"""
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            message = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+            params = {}
+            for part in message.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                payload = part.get_payload(decode=True) or b''
+                if part.get_filename():
+                    params[name] = {'size': len(payload)}
+                else:
+                    params[name] = payload.decode('utf-8', 'replace')
+            return params
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        return {key: values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+
+    def do_POST(self):
+        body, first_byte = self._read_body()
+        method = self.path.rsplit('/', 1)[-1]
+        params = self._parse_params(body)
+        chat_id = int(params.get('chat_id', 0) or 0)
+        chat = {'id': chat_id, 'type': 'private'}
+
+        if method == 'getMe':
+            self._reply({'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}})
+            return
+        if method not in ('sendMessage', 'editMessageText', 'sendAudio', 'sendVideo', 'sendDocument'):
+            self._reply({'ok': True, 'result': True})
+            return
+
+        with self.lock:
+            if method == 'editMessageText':
+                message_id = int(params.get('message_id', 0))
+            else:
+                message_id = self.message_ids.get(chat_id, 1000) + 1
+                self.message_ids[chat_id] = message_id
+
+            event = {
+                'index': len(self.events),
+                'method': method,
+                'chat_id': chat_id,
+                'message_id': message_id,
+                'text': params.get('text', ''),
+                'reply_markup': params.get('reply_markup') or '',
+                'first_byte': first_byte,
+                'time': time.time(),
+                'bytes': len(body),
+            }
+            self.events.append(event)
+
+        result = {'message_id': message_id, 'date': int(time.time()), 'chat': chat, 'text': event['text']}
+        media = method[len('send'):].lower()
+        if media in ('audio', 'video', 'document'):
+            file_id = f"bench-{event['index']}"
+            result[media] = {'file_id': file_id, 'file_unique_id': file_id, 'duration': 1, 'width': 1, 'height': 1}
+            result.pop('text')
+        self._reply({'ok': True, 'result': result})
+
+
+def serve_fakes(bandwidth, ports):
+    """Run the media server and the fake Bot API (in their own process, so they don't skew the numbers)"""
+    MediaHandler.bandwidth = bandwidth
+    media = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    api = ThreadingHTTPServer(('127.0.0.1', 0), BotAPIHandler)
+    media.daemon_threads = api.daemon_threads = True
+    threading.Thread(target=media.serve_forever, daemon=True).start()
+    ports.put((media.server_address[1], api.server_address[1]))
+    api.serve_forever()
+
+
+# --- Stub yt-dlp extractor ----------------------------------------------------
+
+def install_stub_extractor(media_url, video_mb, audio_mb, extract_delay, playlist_size):
+    """Make yt-dlp answer YouTube URLs with synthetic videos served by the media server"""
+    import yt_dlp
+    from yt_dlp.extractor.common import InfoExtractor
+
+    video_bytes = int(video_mb * 1024 * 1024)
+    audio_bytes = int(audio_mb * 1024 * 1024)
+
+    class FakeYoutubeIE(InfoExtractor):
+        IE_NAME = 'youtube'
+        _VALID_URL = r'https?://(?:www\.)?youtube\.com/(?:watch\?v=(?P<id>[\w-]+)|playlist\?list=(?P<list>[\w-]+))'
+
+        def _real_extract(self, url):
+            if extract_delay:
+                time.sleep(extract_delay)  # Stand-in for YouTube's page and player requests
+            video_id, playlist_id = self._match_valid_url(url).group('id', 'list')
+
+            if playlist_id:
+                entries = [
+                    self.url_result(f"https://www.youtube.com/watch?v={playlist_id}-{i}", FakeYoutubeIE,
+                                    f"{playlist_id}-{i}", f"Item {i}")
+                    for i in range(1, playlist_size + 1)
+                ]
+                return self.playlist_result(entries, playlist_id, f"Playlist {playlist_id}")
+
+            def media(format_id, size):
+                return f"{media_url}/media/{video_id}-{format_id}?size={size}"
+
+            return {
+                'id': video_id,
+                'title': f"Video {video_id}",
+                'duration': 300,
+                'formats': [
+                    {'format_id': '139', 'url': media('139', audio_bytes // 3), 'ext': 'm4a', 'vcodec': 'none',
+                     'acodec': 'mp4a.40.5', 'abr': 48, 'filesize': audio_bytes // 3},
+                    {'format_id': '140', 'url': media('140', audio_bytes), 'ext': 'm4a', 'vcodec': 'none',
+                     'acodec': 'mp4a.40.2', 'abr': 128, 'filesize': audio_bytes},
+                    {'format_id': '18', 'url': media('18', video_bytes // 2), 'ext': 'mp4', 'vcodec': 'avc1.42001E',
+                     'acodec': 'mp4a.40.2', 'height': 360, 'width': 640, 'tbr': 600, 'filesize': video_bytes // 2},
+                    {'format_id': '22', 'url': media('22', video_bytes), 'ext': 'mp4', 'vcodec': 'avc1.64001F',
+                     'acodec': 'mp4a.40.2', 'height': 720, 'width': 1280, 'tbr': 1200, 'filesize': video_bytes},
+                ],
+            }
+
+    class FakeYoutubeDL(yt_dlp.YoutubeDL):
+        """YoutubeDL that tries the stub extractor before all the real ones"""
+
+        def __init__(self, params=None, auto_init=True):
+            super().__init__(dict(params or {}, noprogress=True), auto_init=False)
+            self.add_info_extractor(FakeYoutubeIE())
+            if auto_init:
+                self.add_default_info_extractors()  # Same setup cost as the real thing
+
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+
+
+# --- Simulated users ----------------------------------------------------------
+
+class EventFeed:
+    """Follows the fake Bot API's event log and wakes up whoever waits for an event"""
+
+    def __init__(self, api_url):
+        import httpx
+        self._client = httpx.AsyncClient(base_url=api_url)
+        self._events = []
+        self._changed = asyncio.Condition()
+
+    async def run(self, interval=0.02):
+        while True:
+            response = await self._client.get('/events', params={'since': len(self._events)})
+            new = response.json()
+            if new:
+                async with self._changed:
+                    self._events.extend(new)
+                    self._changed.notify_all()
+            await asyncio.sleep(interval)
+
+    def since(self, index, chat_id):
+        return [event for event in self._events[index:] if event['chat_id'] == chat_id]
+
+    def mark(self):
+        return len(self._events)
+
+    async def wait(self, chat_id, predicate, since=0, timeout=600):
+        """Return the first event of the chat after index since that matches predicate"""
+        async def first_match():
+            async with self._changed:
+                while True:
+                    for event in self.since(since, chat_id):
+                        if predicate(event):
+                            return event
+                    await self._changed.wait()
+        return await asyncio.wait_for(first_match(), timeout)
+
+    async def close(self):
+        await self._client.aclose()
+
+
+def _buttons(event):
+    """callback_data of the inline buttons in a recorded message"""
+    if not event['reply_markup']:
+        return []
+    markup = event['reply_markup']
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    return [button.get('callback_data') for row in markup.get('inline_keyboard', []) for button in row]
+
+
+class SimulatedUser:
+    """One chat with the bot: sends a URL, picks type and quality, and waits for the files"""
+
+    update_ids = iter(range(1, 10 ** 9))
+
+    def __init__(self, application, feed, user_id, url, download_type, quality):
+        self.application = application
+        self.feed = feed
+        self.user_id = user_id
+        self.url = url
+        self.download_type = download_type
+        self.quality = quality
+
+    def _user(self):
+        return {'id': self.user_id, 'is_bot': False, 'first_name': f"User {self.user_id}"}
+
+    async def _send(self, data):
+        from telegram import Update
+        data['update_id'] = next(self.update_ids)
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+
+    async def _press(self, message_id, callback_data):
+        await self._send({'callback_query': {
+            'id': str(self.user_id), 'from': self._user(), 'chat_instance': str(self.user_id), 'data': callback_data,
+            'message': {'message_id': message_id, 'date': int(time.time()), 'text': '',
+                        'chat': {'id': self.user_id, 'type': 'private'}},
+        }})
+
+    async def run(self):
+        """Go through the whole conversation and return its timings"""
+        chat_id = self.user_id
+        since = self.feed.mark()
+        await self._send({'message': {
+            'message_id': 1, 'date': int(time.time()), 'text': self.url, 'from': self._user(),
+            'chat': {'id': chat_id, 'type': 'private'},
+        }})
+
+        event = await self.feed.wait(chat_id, lambda e: 'type_audio' in _buttons(e), since)
+        message_id = event['message_id']
+        since = event['index'] + 1
+        await self._press(message_id, f"type_{self.download_type}")
+
+        event = await self.feed.wait(chat_id, lambda e: any(b.startswith('download_') for b in _buttons(e)), since)
+        wanted = f"download_{self.download_type}_{self.quality}"
+        offered = [b for b in _buttons(event) if b.startswith('download_')]
+        requested_at = time.time()
+        since = event['index'] + 1
+        await self._press(message_id, wanted if wanted in offered else offered[0])
+
+        def finished_or_asked(e):
+            return (e['method'] == 'editMessageText' and e['message_id'] == message_id
+                    and (e['text'].startswith(TERMINAL_MARKS) or any(b.startswith('download_') for b in _buttons(e))))
+
+        while True:
+            event = await self.feed.wait(chat_id, finished_or_asked, since)
+            since = event['index'] + 1
+            offered = [b for b in _buttons(event) if b.startswith('download_')]
+            if not offered:
+                break
+            await self._press(message_id, offered[0])  # Over the upload limit: take the quality that fits
+
+        uploads = [e for e in self.feed.since(0, chat_id) if e['method'] in ('sendAudio', 'sendVideo', 'sendDocument')]
+        succeeded = event['text'].startswith('✅') and bool(uploads)
+        return {
+            'kind': 'playlist' if 'list=' in self.url else 'single',
+            'ok': succeeded,
+            'status': event['text'].splitlines()[0],
+            'files': len(uploads),
+            'bytes': sum(e['bytes'] for e in uploads),
+            'ttfb': uploads[0]['first_byte'] - requested_at if uploads else None,
+            'delivery': max(e['time'] for e in uploads) - requested_at if uploads else None,
+        }
+
+
+# --- Measurements -------------------------------------------------------------
+
+def percentile(values, pct):
+    """Linear-interpolated percentile, None for no values"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass  # Removed while walking
+    return total
+
+
+async def sample_disk(path, peak, interval=0.1):
+    while True:
+        peak[0] = max(peak[0], directory_size(path))
+        await asyncio.sleep(interval)
+
+
+def cpu_seconds(who):
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def cold_start_seconds(repeats=3):
+    """Best wall time of a fresh interpreter importing the bot and setting it up, like a new worker"""
+    best = None
+    for _ in range(repeats):
+        start = time.monotonic()
+        subprocess.run([sys.executable, '-c', 'import bot; bot.YouTubeBot()'], check=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.monotonic() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def summarize(results, kind=None):
+    picked = [r for r in results if kind is None or r['kind'] == kind]
+    done = [r for r in picked if r['ok']]
+    ttfb = [r['ttfb'] for r in done]
+    delivery = [r['delivery'] for r in done]
+    return {
+        'jobs': len(picked),
+        'failed': len(picked) - len(done),
+        'files': sum(r['files'] for r in done),
+        'ttfb_p50': percentile(ttfb, 50),
+        'ttfb_p95': percentile(ttfb, 95),
+        'delivery_p50': percentile(delivery, 50),
+        'delivery_p95': percentile(delivery, 95),
+    }
+
+
+# --- Benchmark ----------------------------------------------------------------
+
+async def run_benchmark(args, api_url, media_url):
+    install_stub_extractor(media_url, args.video_mb, args.audio_mb, args.extract_delay, args.playlist_size)
+
+    # Imported only now: the bot reads its configuration at import time
+    import logging
+    from bot import YouTubeBot
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    bot = YouTubeBot(runs_jobs=True)
+    application = bot.build_application()
+    bot.add_handlers(application)
+
+    feed = EventFeed(api_url)
+    peak_disk = [0]
+    helpers = [asyncio.create_task(feed.run()), asyncio.create_task(sample_disk(bot.downloader.download_path, peak_disk))]
+
+    users = []
+    for n in range(args.users):
+        user_id = 100000 + n
+        download_type = 'audio' if n % 2 else 'video'
+        if n < args.playlists:
+            url = f"https://www.youtube.com/playlist?list=PLbench{n}"
+        else:
+            url = f"https://www.youtube.com/watch?v=bench{n}"
+        users.append(SimulatedUser(application, feed, user_id, url, download_type,
+                                   'medium' if download_type == 'audio' else args.quality))
+
+    cpu_before = cpu_seconds(resource.RUSAGE_SELF) if resource else 0.0
+    async with application:
+        await application.start()
+        await bot.post_init(application)
+        started = time.time()
+        try:
+            results = await asyncio.gather(*(user.run() for user in users), return_exceptions=True)
+        finally:
+            elapsed = time.time() - started
+            await bot.post_shutdown(application)
+            await application.stop()
+            bot.downloader.shutdown()
+    cpu_used = cpu_seconds(resource.RUSAGE_SELF) - cpu_before if resource else 0.0
+    # Process pool workers (DOWNLOAD_EXECUTOR=process) are reaped by now
+    child_cpu = cpu_seconds(resource.RUSAGE_CHILDREN) if resource else 0.0
+
+    for task in helpers:
+        task.cancel()
+    await asyncio.gather(*helpers, return_exceptions=True)
+    await feed.close()
+
+    results = [
+        r if not isinstance(r, BaseException)
+        else {'kind': 'error', 'ok': False, 'status': repr(r), 'files': 0, 'bytes': 0, 'ttfb': None, 'delivery': None}
+        for r in results
+    ]
+    completed = sum(1 for r in results if r['ok'])
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': vars(args),
+        'elapsed': elapsed,
+        'jobs_per_minute': completed / elapsed * 60 if elapsed else None,
+        'cpu_seconds': cpu_used + child_cpu,
+        'cpu_percent': (cpu_used + child_cpu) / elapsed * 100 if elapsed else None,
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_disk_mb': peak_disk[0] / (1024 * 1024),
+        'overall': summarize(results),
+        'single': summarize(results, 'single'),
+        'playlist': summarize(results, 'playlist'),
+        'errors': sorted({r['status'] for r in results if not r['ok']}),
+    }
+
+
+def print_report(report):
+    def seconds(value):
+        return f"{value:7.2f}s" if value is not None else "      -"
+
+    print(f"\n📊 Benchmark results (commit {report['commit'] or 'unknown'})")
+    print(f"   {'':10} {'jobs':>5} {'failed':>6} {'TTFB p50':>9} {'TTFB p95':>9} {'done p50':>9} {'done p95':>9}")
+    for kind in ('single', 'playlist', 'overall'):
+        s = report[kind]
+        if not s['jobs']:
+            continue
+        print(f"   {kind:10} {s['jobs']:>5} {s['failed']:>6} {seconds(s['ttfb_p50']):>9} {seconds(s['ttfb_p95']):>9} "
+              f"{seconds(s['delivery_p50']):>9} {seconds(s['delivery_p95']):>9}")
+    print(f"   Cold start:  {report['cold_start_seconds']:.2f}s (import and set up the bot)")
+    print(f"   Wall time:   {report['elapsed']:.1f}s")
+    print(f"   Throughput:  {report['jobs_per_minute']:.1f} jobs/min")
+    print(f"   CPU:         {report['cpu_seconds']:.1f}s ({report['cpu_percent']:.0f}% of one core)")
+    if report['peak_rss_mb'] is not None:
+        print(f"   Peak RSS:    {report['peak_rss_mb']:.0f} MB")
+    print(f"   Peak disk:   {report['peak_disk_mb']:.0f} MB")
+    for error in report['errors']:
+        print(f"   ❌ {error}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark for the bot")
+    parser.add_argument('--users', type=int, default=10, help="Simulated users, all starting at once")
+    parser.add_argument('--playlists', type=int, default=1, help="How many of the users send a playlist")
+    parser.add_argument('--playlist-size', type=int, default=5, help="Items per playlist")
+    parser.add_argument('--quality', default='720p', help="Video quality the users pick (720p or 360p)")
+    parser.add_argument('--video-mb', type=float, default=8, help="Size of the 720p video; 360p is half")
+    parser.add_argument('--audio-mb', type=float, default=3, help="Size of the medium-quality audio")
+    parser.add_argument('--bandwidth', type=float, default=0, help="MB/s per download connection, 0 for unlimited")
+    parser.add_argument('--extract-delay', type=float, default=0.2, help="Seconds each metadata extraction takes")
+    parser.add_argument('--json', metavar='PATH', help="Also write the results to this file")
+    parser.add_argument('--keep', action='store_true', help="Keep the temporary work directory")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    ports = multiprocessing.Queue()
+    fakes = multiprocessing.Process(target=serve_fakes, args=(int(args.bandwidth * 1024 * 1024), ports), daemon=True)
+    fakes.start()
+    media_port, api_port = ports.get(timeout=30)
+    media_url, api_url = f"http://127.0.0.1:{media_port}", f"http://127.0.0.1:{api_port}"
+
+    workdir = tempfile.mkdtemp(prefix='ytbot-bench-')
+    # Everything the bot stores goes to the work directory, and it talks to the fake Bot API
+    os.environ.update({
+        'BOT_TOKEN': '123456:benchmark',
+        'BOT_MODE': 'polling',
+        'WORKER_MODE': 'false',
+        'BOT_API_URL': api_url,
+        'DOWNLOAD_PATH': os.path.join(workdir, 'downloads'),
+        'DATA_PATH': os.path.join(workdir, 'data'),
+        'JOB_QUEUE_PATH': os.path.join(workdir, 'data', 'jobs.sqlite3'),
+        'FILE_ID_CACHE_PATH': os.path.join(workdir, 'data', 'file_ids.sqlite3'),
+        'SESSION_DB_PATH': os.path.join(workdir, 'data', 'sessions.sqlite3'),
+    })
+    # Uploaded like to the cloud API unless asked otherwise; synthetic media can't be transcoded
+    os.environ.setdefault('BOT_API_LOCAL_MODE', 'false')
+    os.environ.setdefault('AUDIO_OUTPUT_FORMAT', 'native')
+
+    print(f"🏁 {args.users} users ({args.playlists} with a {args.playlist_size}-item playlist), "
+          f"media at {media_url}, Bot API at {api_url}")
+    try:
+        cold_start = cold_start_seconds()
+        report = asyncio.run(run_benchmark(args, api_url, media_url))
+        report['cold_start_seconds'] = cold_start
+    finally:
+        fakes.terminate()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"   Saved to {args.json}")
+    return 0 if not report['errors'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,22 +1,82 @@
+import time
+STARTED_AT = time.monotonic()  # Before the imports below, which are most of the startup time
+
 import asyncio
 import logging
+from pathlib import Path
+from typing import Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from youtube_downloader import YouTubeDownloader
-from config import BOT_TOKEN, AUDIO_QUALITY_PRESETS, VIDEO_QUALITY_PRESETS
+from youtube_downloader import YouTubeDownloader, FileTooLargeError
+from file_id_cache import FileIdCache
+from progress import DownloadProgress
+from singleflight import SingleFlight, CoalescedCallCancelled
+from metrics import (
+    serve_metrics, BYTES, JOB_FAILURES, CACHE_HITS, CACHE_MISSES, QUEUE_DEPTH, ACTIVE_JOBS,
+    POOL_ACTIVE, POOL_QUEUED, DISK_USAGE, STARTUP_SECONDS
+)
+from session_store import create_session_store
+from tracing import configure_logging, message_trace_id, set_trace, reset_trace, timed_stage, JobProfiler
+from scheduler import JobStore, JobScheduler, QueueLimitError, PENDING, DONE, FAILED, CANCELLED
+from storage import StorageFullError
+from worker_pool import WorkerPoolFullError
+from config import (
+    BOT_TOKEN, AUDIO_QUALITY_PRESETS, VIDEO_QUALITY_PRESETS, FILE_ID_CACHE_PATH, ADMIN_USER_IDS, TELEGRAM_UPLOAD_LIMIT_MB,
+    BOT_API_URL, BOT_API_LOCAL_MODE, UPLOAD_TIMEOUT, SPLIT_OVERSIZED, UPLOAD_CONCURRENCY,
+    SESSION_STORE, SESSION_TTL, SESSION_DB_PATH,
+    WORKER_MODE, WORKER_POLL_INTERVAL, WORKER_TIMEOUT, PROGRESS_UPDATE_INTERVAL, METRICS_PORT, METRICS_LISTEN,
+    LOG_FORMAT, LOG_LEVEL, PROFILE_JOBS, PROFILE_PATH,
+    BOT_MODE, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, INSTANCE_NAME,
+    JOB_QUEUE_PATH, MAX_CONCURRENT_JOBS, MAX_JOBS_PER_USER, MAX_PENDING_PER_USER, JOB_AGING_SECONDS,
+    validate_config
+)
 import os
 
 # Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+configure_logging(LOG_FORMAT, LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
+BUSY_TEXT = "🚦 The bot is busy right now. Please try again in a minute."
+CANCELLED_TEXT = "🚫 Download cancelled."
+
+# The only updates the handlers below use; Telegram doesn't send the rest at all
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
 class YouTubeBot:
-    def __init__(self):
+    def __init__(self, runs_jobs: bool = None, worker_name: str = None):
+        # With WORKER_MODE on, the bot process only queues jobs and worker.py processes run them
+        self.runs_jobs = not WORKER_MODE if runs_jobs is None else runs_jobs
         self.downloader = YouTubeDownloader()
-        self.user_states = {}  # Store user states for multi-step interactions
+        self.file_id_cache = FileIdCache(FILE_ID_CACHE_PATH)
+        self.inflight = SingleFlight()  # Identical downloads running right now, keyed by (video, type, quality)
+        self.job_store = JobStore(JOB_QUEUE_PATH, MAX_JOBS_PER_USER, MAX_PENDING_PER_USER, JOB_AGING_SECONDS)
+        self.scheduler = JobScheduler(
+            self.job_store, self.run_job, MAX_CONCURRENT_JOBS, worker=worker_name or f"bot-{INSTANCE_NAME}",
+            on_queue_changed=self.report_queue_positions, poll_interval=WORKER_POLL_INTERVAL,
+            worker_timeout=WORKER_TIMEOUT
+        )
+        self.progress_reporters = {}  # Job ID -> task keeping its status message up to date
+        self.application = None
+        self.background_tasks = []
+        # Compact per-message state between the URL and the quality choice, expiring after SESSION_TTL
+        self.sessions = create_session_store(SESSION_STORE, SESSION_TTL, SESSION_DB_PATH)
+        self._register_metrics()
+    
+    def _register_metrics(self):
+        """Expose state the bot already tracks as metrics, read whenever they are scraped."""
+        caches = {'metadata': self.downloader.metadata_cache, 'file_id': self.file_id_cache}
+        for name, cache in caches.items():
+            CACHE_HITS.set_function(lambda cache=cache: cache.hits, cache=name)
+            CACHE_MISSES.set_function(lambda cache=cache: cache.misses, cache=name)
+        for pool in (self.downloader.extract_pool, self.downloader.download_pool):
+            POOL_ACTIVE.set_function(lambda pool=pool: pool.active, pool=pool.name)
+            POOL_QUEUED.set_function(lambda pool=pool: pool.queued, pool=pool.name)
+        QUEUE_DEPTH.set_function(lambda: self.job_store.count(PENDING))
+        ACTIVE_JOBS.set_function(lambda: len(self.scheduler.active))
+        if self.runs_jobs:
+            # As of the last storage sweep: walking the download path on every scrape would block the event loop
+            DISK_USAGE.set_function(lambda: self.downloader.storage.measured_usage)
         
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Send a message when the command /start is issued."""
@@ -43,10 +103,10 @@ I can help you download audio or video from YouTube videos and playlists.
 /start - Show this help message
 /help - Show detailed help
 /quality - Set default quality
-/cleanup - Clean up downloaded files
+/cleanup - Clean up your leftover downloads
 
-⚠️ **Note:** No file size limits - download any quality you want!
-        """
+⚠️ **Note:** Telegram limits uploads to {limit} MB. If a quality would be larger, I'll offer a smaller one.
+        """.format(limit=TELEGRAM_UPLOAD_LIMIT_MB)
         
         keyboard = [
             [InlineKeyboardButton("📚 Help", callback_data="help")],
@@ -103,7 +163,7 @@ I can help you download audio or video from YouTube videos and playlists.
 
 💡 **Tips:**
 • Use /quality to set your preferred quality
-• Use /cleanup to free up space
+• Use /cleanup to remove your leftover downloads
 • For large playlists, consider downloading in smaller batches
 • 4K and 2K downloads may take longer and create larger files
         """
@@ -128,10 +188,14 @@ I can help you download audio or video from YouTube videos and playlists.
     async def cleanup_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Clean up downloaded files."""
         try:
-            self.downloader.cleanup_downloads()
-            await update.message.reply_text("🧹 Download directory cleaned up successfully!")
+            # Admins clear every leftover download; everyone else only their own.
+            # Downloads still in progress or being delivered are never removed.
+            user_id = update.effective_user.id
+            owner = None if user_id in ADMIN_USER_IDS else user_id
+            removed = await self.downloader.cleanup_downloads(owner)
+            await update.effective_message.reply_text(f"🧹 Cleaned up {removed} leftover downloads!")
         except Exception as e:
-            await update.message.reply_text(f"❌ Error during cleanup: {str(e)}")
+            await update.effective_message.reply_text(f"❌ Error during cleanup: {str(e)}")
     
     async def handle_youtube_url(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle YouTube URLs sent by users."""
@@ -144,6 +208,8 @@ I can help you download audio or video from YouTube videos and playlists.
         
         # Send initial response
         status_message = await update.message.reply_text("🔍 Analyzing YouTube URL...")
+        # The buttons and the job reuse this message, so its ID follows the URL all the way
+        trace = set_trace(message_trace_id(status_message.chat_id, status_message.message_id))
         
         try:
             # Check if it's a playlist
@@ -156,7 +222,8 @@ I can help you download audio or video from YouTube videos and playlists.
             
             if is_playlist:
                 playlist_title = info.get('title', 'Playlist')
-                video_count = len(info.get('entries', []))
+                # Entries are listed flat and capped, so prefer the reported total
+                video_count = info.get('playlist_count') or len(info.get('entries', []))
                 await status_message.edit_text(
                     f"📋 **Playlist Detected:** {playlist_title}\n"
                     f"🎵 **Items:** {video_count}\n\n"
@@ -173,17 +240,19 @@ I can help you download audio or video from YouTube videos and playlists.
                     "What would you like to download?"
                 )
             
-            # Store user state
-            self.user_states[user_id] = {
+            # Keep only what the next steps need; the full info stays in the metadata cache
+            self.sessions.set(self._session_key(status_message), {
+                'user_id': user_id,
                 'url': url,
                 'is_playlist': is_playlist,
-                'info': info
-            }
+                'video_id': info.get('id'),
+                'title': info.get('title')
+            })
             
             # Show download type selection
             keyboard = [
-                [InlineKeyboardButton("🎵 Audio Only", callback_data=f"type_audio_{user_id}")],
-                [InlineKeyboardButton("🎬 Video", callback_data=f"type_video_{user_id}")]
+                [InlineKeyboardButton("🎵 Audio Only", callback_data="type_audio")],
+                [InlineKeyboardButton("🎬 Video", callback_data="type_video")]
             ]
             
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -192,9 +261,13 @@ I can help you download audio or video from YouTube videos and playlists.
                 reply_markup=reply_markup
             )
             
+        except WorkerPoolFullError:
+            await status_message.edit_text(BUSY_TEXT)
         except Exception as e:
             logger.error(f"Error handling URL: {e}")
             await status_message.edit_text(f"❌ Error analyzing URL: {str(e)}")
+        finally:
+            reset_trace(trace)
     
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle button callbacks."""
@@ -202,7 +275,15 @@ I can help you download audio or video from YouTube videos and playlists.
         await query.answer()
         
         data = query.data
-        
+        trace = set_trace(message_trace_id(query.message.chat_id, query.message.message_id)) if query.message else None
+        try:
+            await self._dispatch_callback(update, context, query, data)
+        finally:
+            if trace:
+                reset_trace(trace)
+    
+    async def _dispatch_callback(self, update, context, query, data):
+        """Route a button press by its callback data."""
         if data == "help":
             await self.help_command(update, context)
         elif data == "set_quality":
@@ -216,20 +297,36 @@ I can help you download audio or video from YouTube videos and playlists.
             await self.handle_type_selection(query, data)
         elif data.startswith("download_"):
             await self.handle_download_callback(query, data)
+        elif data.startswith("cancel_"):
+            await self.handle_cancel_callback(query, data)
+    
+    def _session_key(self, message):
+        """Sessions belong to the message carrying the buttons, so each URL keeps its own."""
+        return f"{message.chat_id}:{message.message_id}"
+    
+    async def _get_session(self, query):
+        """Load the session behind a button press, or tell the user it has expired."""
+        user_state = self.sessions.get(self._session_key(query.message))
+        if user_state is None:
+            await query.edit_message_text("❌ Session expired. Please send the URL again.")
+            return None
+        if user_state['user_id'] != query.from_user.id:
+            # Someone else's buttons, e.g. in a group chat
+            return None
+        return user_state
     
     async def handle_type_selection(self, query, data):
         """Handle download type selection (audio/video)."""
         try:
             parts = data.split("_")
             download_type = parts[1]  # audio or video
-            user_id = int(parts[2])
             
-            if user_id not in self.user_states:
-                await query.edit_message_text("❌ Session expired. Please send the URL again.")
+            user_state = await self._get_session(query)
+            if user_state is None:
                 return
             
-            user_state = self.user_states[user_id]
             user_state['download_type'] = download_type
+            self.sessions.set(self._session_key(query.message), user_state)
             
             # Show quality selection
             if download_type == 'audio':
@@ -239,10 +336,19 @@ I can help you download audio or video from YouTube videos and playlists.
                 quality_presets = VIDEO_QUALITY_PRESETS
                 type_text = "🎬 Video"
             
+            # Only offer what the video really has; the probe behind this is cached
+            available = await self.downloader.get_available_qualities(user_state['url'], download_type)
+            qualities = [quality for quality in quality_presets if quality in available] or list(quality_presets)
+            
+            # Playlist items differ in length, so sizes are only shown for single videos
+            sizes = {}
+            if not user_state['is_playlist']:
+                sizes = await self.downloader.estimate_sizes(user_state['url'], download_type)
+            
             # Create keyboard with quality options
             keyboard = []
             row = []
-            for i, (quality, description) in enumerate(quality_presets.items()):
+            for quality in qualities:
                 # Create quality labels with resolution info
                 if download_type == 'video':
                     if quality == '4k':
@@ -262,9 +368,14 @@ I can help you download audio or video from YouTube videos and playlists.
                 else:
                     label = f"{quality.title()}"
                 
+                if sizes.get(quality):
+                    label += f" ~{self._format_size(sizes[quality])}"
+                    if sizes[quality] > self.downloader.upload_limit:
+                        label = "⚠️ " + label
+                
                 row.append(InlineKeyboardButton(
                     label, 
-                    callback_data=f"download_{download_type}_{quality}_{user_id}"
+                    callback_data=f"download_{download_type}_{quality}"
                 ))
                 
                 # Create new row every 2 buttons for better layout
@@ -283,152 +394,535 @@ I can help you download audio or video from YouTube videos and playlists.
                 reply_markup=reply_markup
             )
                 
+        except WorkerPoolFullError:
+            await query.edit_message_text(BUSY_TEXT)
         except Exception as e:
             logger.error(f"Error handling type selection: {e}")
             await query.edit_message_text(f"❌ Error during type selection: {str(e)}")
     
+    def _describe(self, download_type, quality):
+        """Return display texts for a download type and quality."""
+        type_text = "🎵 Audio" if download_type == 'audio' else "🎬 Video"
+        if download_type == 'video':
+            quality_display = {
+                '4k': '4K (2160p)',
+                '2k': '2K (1440p)',
+                '1080p': '1080p (FHD)',
+                '720p': '720p (HD)',
+                '480p': '480p (SD)',
+                '360p': '360p (LD)'
+            }.get(quality, quality.title())
+        else:
+            quality_display = quality.title()
+        return type_text, quality_display
+    
+    def _queued_text(self, job, position):
+        """Status text for a job waiting in the queue."""
+        type_text, quality_display = self._describe(job['download_type'], job['quality'])
+        return (
+            f"🕒 {type_text} download with {quality_display} quality is queued.\n"
+            f"Position in queue: {position}"
+        )
+    
+    def _cancel_markup(self, job):
+        """Cancel button shown under a job's status until it finishes."""
+        return InlineKeyboardMarkup([[InlineKeyboardButton("✖️ Cancel", callback_data=f"cancel_{job['id']}")]])
+    
+    def _format_size(self, size):
+        """Human-readable size for quality labels."""
+        if size >= 1024 * 1024 * 1024:
+            return f"{size / (1024 * 1024 * 1024):.1f} GB"
+        return f"{max(1, round(size / (1024 * 1024)))} MB"
+    
+    def _fail(self, job, reason, error):
+        """Record a job as failed, counting it under a short reason for the metrics."""
+        JOB_FAILURES.inc(reason=reason)
+        self.job_store.finish(job['id'], FAILED, error=error)
+    
+    async def _edit_status(self, job, text, reply_markup=None):
+        """Update a job's status message, ignoring edits Telegram refuses."""
+        await self._stop_progress(job)
+        try:
+            await self.application.bot.edit_message_text(
+                text, chat_id=job['chat_id'], message_id=job['message_id'], reply_markup=reply_markup
+            )
+        except BadRequest as e:
+            # Unchanged text or a deleted message shouldn't fail the job
+            logger.debug(f"Could not update status for job {job['id']}: {e}")
+    
     async def handle_download_callback(self, query, data):
-        """Handle download quality selection."""
+        """Handle download quality selection by queueing the download."""
         try:
             parts = data.split("_")
             download_type = parts[1]  # audio or video
             quality = parts[2]
-            user_id = int(parts[3])
+            split = len(parts) > 3 and parts[3] == 'split'  # Keep this quality and send it in parts
             
-            if user_id not in self.user_states:
-                await query.edit_message_text("❌ Session expired. Please send the URL again.")
+            user_state = await self._get_session(query)
+            if user_state is None:
                 return
+            user_id = user_state['user_id']
             
-            user_state = self.user_states[user_id]
-            url = user_state['url']
-            is_playlist = user_state['is_playlist']
+            if not user_state['is_playlist'] and not split:
+                # Don't spend a download on a file Telegram won't accept
+                fitting = await self.downloader.fit_quality(user_state['url'], download_type, quality)
+                if fitting is None and not SPLIT_OVERSIZED:
+                    await query.edit_message_text(
+                        f"❌ This video is larger than Telegram's {TELEGRAM_UPLOAD_LIMIT_MB} MB upload limit in every quality."
+                    )
+                    return
+                if fitting is not None and fitting != quality:
+                    _, requested = self._describe(download_type, quality)
+                    _, smaller = self._describe(download_type, fitting)
+                    keyboard = [[InlineKeyboardButton(
+                        f"📥 Download {smaller}", callback_data=f"download_{download_type}_{fitting}"
+                    )]]
+                    if SPLIT_OVERSIZED:
+                        keyboard.append([InlineKeyboardButton(
+                            f"📦 {requested} in parts", callback_data=f"download_{download_type}_{quality}_split"
+                        )])
+                    await query.edit_message_text(
+                        f"⚠️ {requested} would be over Telegram's {TELEGRAM_UPLOAD_LIMIT_MB} MB upload limit.\n\n"
+                        f"The best quality that fits is {smaller}:",
+                        reply_markup=InlineKeyboardMarkup(keyboard)
+                    )
+                    return
             
-            # Create quality display text
-            if download_type == 'video':
-                quality_display = {
-                    '4k': '4K (2160p)',
-                    '2k': '2K (1440p)',
-                    '1080p': '1080p (FHD)',
-                    '720p': '720p (HD)',
-                    '480p': '480p (SD)',
-                    '360p': '360p (LD)'
-                }.get(quality, quality.title())
-            else:
-                quality_display = quality.title()
+            try:
+                job_id = self.scheduler.submit(
+                    user_id=user_id,
+                    chat_id=query.message.chat_id,
+                    message_id=query.message.message_id,
+                    url=user_state['url'],
+                    download_type=download_type,
+                    quality=quality,
+                    is_playlist=user_state['is_playlist'],
+                    video_id=user_state['video_id'],
+                    title=user_state['title'],
+                    split=split
+                )
+            except QueueLimitError:
+                await query.edit_message_text(
+                    "🚦 You already have several downloads waiting. Please wait for them to finish."
+                )
+                return
             
-            # Update status message
-            type_text = "🎵 Audio" if download_type == 'audio' else "🎬 Video"
-            await query.edit_message_text(
-                f"⏳ Downloading {type_text} with {quality_display} quality...\n"
-                f"Please wait, this may take a while."
-            )
+            # The buttons are gone once the job is queued
+            self.sessions.delete(self._session_key(query.message))
             
-            if is_playlist:
-                await self.download_playlist_for_user(query, url, download_type, quality, user_id)
-            else:
-                await self.download_single_video_for_user(query, url, download_type, quality, user_id)
+            job = self.job_store.get(job_id)
+            position = self.scheduler.position(job_id) or 1
+            self.job_store.record_position(job_id, position)
+            await query.edit_message_text(self._queued_text(job, position), reply_markup=self._cancel_markup(job))
+            
+            # Start dispatching only now, so the queued text can't overwrite the job's first update
+            self.scheduler.wake()
                 
         except Exception as e:
             logger.error(f"Error handling download callback: {e}")
             await query.edit_message_text(f"❌ Error during download: {str(e)}")
     
-    async def download_single_video_for_user(self, query, url, download_type, quality, user_id):
-        """Download a single video for a user."""
+    async def report_queue_positions(self, positions):
+        """Tell waiting users their new place in the queue.
+
+        Worker processes sharing the queue all call this; the position is
+        recorded in the queue, so only the first of them edits the message.
+        """
+        for job in self.job_store.pending_jobs():
+            position = positions.get(job['id'])
+            if position is None or not self.job_store.record_position(job['id'], position):
+                continue
+            await self._edit_status(job, self._queued_text(job, position), self._cancel_markup(job))
+    
+    async def handle_cancel_callback(self, query, data):
+        """Cancel a queued or running job from the button under its status message."""
         try:
-            file_path = await self.downloader.download_single_video(url, download_type, quality)
+            job = self.job_store.get(int(data.split("_")[1]))
+            if job is None or job['user_id'] != query.from_user.id:
+                return  # Long gone, or someone else's job in a group chat
             
-            if file_path and os.path.exists(file_path):
-                if download_type == 'audio':
-                    # Send the audio file
-                    with open(file_path, 'rb') as audio_file:
-                        await query.message.reply_audio(
-                            audio_file,
-                            title=os.path.basename(file_path).replace('.mp3', ''),
-                            performer="YouTube Audio"
-                        )
-                else:
-                    # Send the video file
-                    with open(file_path, 'rb') as video_file:
-                        await query.message.reply_video(
-                            video_file,
-                            caption=f"YouTube Video - {quality.upper()} Quality"
-                        )
-                
-                # Clean up the file
-                os.remove(file_path)
+            previous = self.scheduler.cancel(job['id'])
+            if previous is None:
+                return  # It finished meanwhile and its final status stands
+            
+            # A running job stops where it is, here or in whichever worker holds it
+            await self._edit_status(job, CANCELLED_TEXT)
+            if previous == PENDING:
+                await self.report_queue_positions(self.job_store.positions())
                 
+        except Exception as e:
+            logger.error(f"Error cancelling job: {e}")
+    
+    async def run_job(self, job):
+        """Run a queued download job and deliver the results to its chat."""
+        trace = set_trace(message_trace_id(job['chat_id'], job['message_id']), job['id'])
+        profiler = JobProfiler(job['id'], PROFILE_PATH) if PROFILE_JOBS else None
+        logger.info(f"Starting job {job['id']}", extra={'url': job['url'], 'download_type': job['download_type'],
+                                                          'quality': job['quality']})
+        type_text, quality_display = self._describe(job['download_type'], job['quality'])
+        await self._edit_status(
+            job,
+            f"⏳ Downloading {type_text} with {quality_display} quality...\n"
+            f"Please wait, this may take a while.",
+            self._cancel_markup(job)
+        )
+        
+        progress = DownloadProgress()
+        self.progress_reporters[job['id']] = asyncio.create_task(self._report_progress(
+            job, f"⏳ Downloading {type_text} with {quality_display} quality...", progress
+        ))
+        try:
+            if job['is_playlist']:
+                await self.download_playlist_for_user(job, progress)
+            else:
+                await self.download_single_video_for_user(job, progress)
+        except asyncio.CancelledError:
+            # Partial files are removed on the way out; make sure the status says why
+            current = self.job_store.get(job['id'])
+            if current and current['status'] == CANCELLED:
+                await self._edit_status(job, CANCELLED_TEXT)
+            raise
+        finally:
+            await self._stop_progress(job)
+            if profiler:
+                profiler.stop()
+            reset_trace(trace)
+    
+    async def _report_progress(self, job, header, progress):
+        """Show live progress in the status message, at most one edit per PROGRESS_UPDATE_INTERVAL."""
+        shown = None
+        while True:
+            await asyncio.sleep(PROGRESS_UPDATE_INTERVAL)
+            text = progress.render()
+            if not text or text == shown:
+                continue  # Editing to the same text is refused anyway
+            try:
+                await self.application.bot.edit_message_text(
+                    f"{header}\n\n{text}", chat_id=job['chat_id'], message_id=job['message_id'],
+                    reply_markup=self._cancel_markup(job)
+                )
+                shown = text
+            except RetryAfter as e:
+                # Flood control: back off for as long as Telegram asks
+                delay = e.retry_after
+                await asyncio.sleep(delay.total_seconds() if hasattr(delay, 'total_seconds') else delay)
+            except TelegramError as e:
+                logger.debug(f"Could not update progress for job {job['id']}: {e}")
+    
+    async def _stop_progress(self, job):
+        """Stop a job's progress updates so they can't overwrite its final status."""
+        reporter = self.progress_reporters.pop(job['id'], None)
+        if reporter:
+            reporter.cancel()
+            await asyncio.gather(reporter, return_exceptions=True)
+    
+    async def _send_cached_file(self, chat_id, video_id, download_type, quality, **kwargs) -> bool:
+        """Re-send a previously uploaded file by its file_id. Returns False on a miss or a stale file_id."""
+        cached = self.file_id_cache.get(video_id, download_type, quality)
+        if not cached:
+            return False
+        
+        file_id, media_type = cached
+        try:
+            await getattr(self.application.bot, f"send_{media_type}")(chat_id, file_id, **kwargs)
+            return True
+        except BadRequest as e:
+            # Telegram no longer accepts this file_id, so forget it and download again
+            logger.warning(f"Cached file_id for {video_id} was rejected: {e}")
+            self.file_id_cache.invalidate(video_id, download_type, quality)
+            return False
+    
+    async def _upload(self, chat_id, file_path, download_type, **kwargs):
+        """Upload one file to a chat and return the sent message."""
+        send = self.application.bot.send_audio if download_type == 'audio' else self.application.bot.send_video
+        timeouts = {'read_timeout': UPLOAD_TIMEOUT, 'write_timeout': UPLOAD_TIMEOUT}
+        
+        with timed_stage('upload'):
+            if BOT_API_LOCAL_MODE:
+                # The local server reads the file itself; only a file:// path is sent
+                sent = await send(chat_id, Path(file_path), **timeouts, **kwargs)
+            else:
+                with open(file_path, 'rb') as media_file:
+                    sent = await send(chat_id, media_file, **timeouts, **kwargs)
+        BYTES.inc(os.path.getsize(file_path), direction='upload')
+        return sent
+    
+    async def _send_parts(self, chat_id, file_path, download_type, **kwargs):
+        """Split an oversized file without re-encoding and upload the parts in parallel."""
+        parts = await self.downloader.split_for_upload(file_path)
+        semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+        
+        async def send_part(number, part_path):
+            label = f"Part {number}/{len(parts)}"
+            part_kwargs = dict(kwargs)
+            part_kwargs['caption'] = f"{kwargs['caption']} ({label})" if kwargs.get('caption') else label
+            if download_type == 'audio':
+                part_kwargs['title'] = f"{kwargs.get('title', 'Audio')} ({label})"
+            async with semaphore:
+                await self._upload(chat_id, part_path, download_type, **part_kwargs)
+        
+        await asyncio.gather(*(send_part(number, part_path) for number, part_path in enumerate(parts, start=1)))
+    
+    async def _send_file(self, chat_id, file_path, video_id, download_type, quality, **kwargs):
+        """Upload a downloaded file and remember its file_id for later requests.
+
+        Files over the upload limit are sent in parts, which aren't cached.
+        """
+        if os.path.getsize(file_path) > self.downloader.upload_limit:
+            if not SPLIT_OVERSIZED:
+                raise FileTooLargeError(f"{os.path.basename(file_path)} is over the upload limit")
+            await self._send_parts(chat_id, file_path, download_type, **kwargs)
+            return
+        
+        sent = await self._upload(chat_id, file_path, download_type, **kwargs)
+        if sent.audio:
+            self.file_id_cache.set(video_id, download_type, quality, sent.audio.file_id, 'audio')
+        elif sent.video:
+            self.file_id_cache.set(video_id, download_type, quality, sent.video.file_id, 'video')
+    
+    async def _download_and_send(self, chat_id, url, video_id, download_type, quality, send_kwargs, owner=None,
+                                 fit_upload_limit=True, progress=None) -> Optional[str]:
+        """Download a video and upload it.
+
+        Returns the quality sent, which is lower than the one asked for if that
+        didn't fit the upload limit, or None if the download failed.
+        """
+        downloaded = await self.downloader.download_single_video(url, download_type, quality, owner, fit_upload_limit, progress)
+        if not downloaded or not os.path.exists(downloaded[0]):
+            return None
+        file_path, quality = downloaded  # The file_id is cached under what was actually sent
+        
+        try:
+            if progress:
+                progress.set_stage("Uploading to Telegram")
+            kwargs = dict(send_kwargs)
+            if download_type == 'audio':
+                kwargs['title'] = os.path.splitext(os.path.basename(file_path))[0]
+            await self._send_file(chat_id, file_path, video_id, download_type, quality, **kwargs)
+        finally:
+            # Clean up the file (or its parts) and the job directory
+            self.downloader.remove_download(file_path)
+        
+        return quality
+    
+    async def _deliver_video(self, chat_id, url, video_id, download_type, quality, send_kwargs, owner=None,
+                             progress=None) -> Optional[str]:
+        """Send one video by cached file_id, by joining an identical running job, or by downloading it.
+
+        Returns the quality sent, as _download_and_send does, or None if it failed.
+        """
+        if await self._send_cached_file(chat_id, video_id, download_type, quality, **send_kwargs):
+            return quality
+        
+        key = (video_id or url, download_type, quality)
+        try:
+            delivered, shared = await self.inflight.do(
+                key, lambda: self._download_and_send(chat_id, url, video_id, download_type, quality, send_kwargs, owner,
+                                                     progress=progress)
+            )
+        except CoalescedCallCancelled:
+            # The job we joined was cancelled by its user; this one still wants the file
+            return await self._download_and_send(chat_id, url, video_id, download_type, quality, send_kwargs, owner,
+                                                 progress=progress)
+        if not shared or not delivered:
+            return delivered
+        
+        # Someone else's identical job just uploaded this file; re-send it by file_id
+        if await self._send_cached_file(chat_id, video_id, download_type, delivered, **send_kwargs):
+            return delivered
+        return await self._download_and_send(chat_id, url, video_id, download_type, quality, send_kwargs, owner,
+                                             progress=progress)
+    
+    async def download_single_video_for_user(self, job, progress=None):
+        """Download a single video for a user, or re-send it if it was uploaded before."""
+        download_type = job['download_type']
+        quality = job['quality']
+        try:
+            if download_type == 'audio':
+                send_kwargs = {'title': job['title'] or 'YouTube Audio', 'performer': "YouTube Audio"}
+            else:
+                send_kwargs = {'caption': f"YouTube Video - {quality.upper()} Quality"}
+            
+            if job['split']:
+                # Full quality on request: nothing cached or shared matches, so download it
+                delivered = await self._download_and_send(job['chat_id'], job['url'], job['video_id'], download_type,
+                                                          quality, send_kwargs, job['user_id'], fit_upload_limit=False,
+                                                          progress=progress)
+            else:
+                delivered = await self._deliver_video(job['chat_id'], job['url'], job['video_id'], download_type,
+                                                      quality, send_kwargs, job['user_id'], progress)
+            
+            if delivered:
+                # Hand the file_id back through the queue for whoever wants the result
+                cached = self.file_id_cache.peek(job['video_id'], download_type, delivered)
+                self.job_store.finish(job['id'], DONE, result=cached[0] if cached else None)
                 type_text = "Audio" if download_type == 'audio' else "Video"
-                await query.edit_message_text(f"✅ {type_text} download completed successfully!")
+                await self._edit_status(job, f"✅ {type_text} download completed successfully!")
             else:
-                await query.edit_message_text("❌ Download failed. Please try again.")
+                self._fail(job, 'download_failed', "download failed")
+                await self._edit_status(job, "❌ Download failed. Please try again.")
                 
+        except FileTooLargeError as e:
+            self._fail(job, 'too_large', str(e))
+            await self._edit_status(
+                job, f"❌ This video is larger than Telegram's {TELEGRAM_UPLOAD_LIMIT_MB} MB upload limit in every quality."
+            )
+        except (WorkerPoolFullError, StorageFullError) as e:
+            self._fail(job, 'busy', str(e))
+            await self._edit_status(job, BUSY_TEXT)
         except Exception as e:
             logger.error(f"Error downloading single video: {e}")
-            await query.edit_message_text(f"❌ Download error: {str(e)}")
-        finally:
-            # Clean up user state
-            if user_id in self.user_states:
-                del self.user_states[user_id]
+            self._fail(job, 'error', str(e))
+            await self._edit_status(job, f"❌ Download error: {str(e)}")
     
-    async def download_playlist_for_user(self, query, url, download_type, quality, user_id):
-        """Download a playlist for a user."""
+    async def download_playlist_for_user(self, job, progress=None):
+        """Download a playlist for a user, sending each item as soon as it is ready."""
+        download_type = job['download_type']
+        quality = job['quality']
+        chat_id = job['chat_id']
+        user_id = job['user_id']
         try:
-            downloaded_files = await self.downloader.download_playlist(url, download_type, quality)
+            type_text = "Audio" if download_type == 'audio' else "Video"
+            sent_count = 0
             
-            if downloaded_files:
-                type_text = "Audio" if download_type == 'audio' else "Video"
-                await query.edit_message_text(f"✅ Downloaded {len(downloaded_files)} {type_text.lower()} files!")
-                
-                # Send each file
-                for i, file_path in enumerate(downloaded_files):
-                    if os.path.exists(file_path):
-                        try:
-                            if download_type == 'audio':
-                                with open(file_path, 'rb') as audio_file:
-                                    await query.message.reply_audio(
-                                        audio_file,
-                                        title=f"{i+1:02d}_{os.path.basename(file_path).replace('.mp3', '')}",
-                                        performer="YouTube Playlist"
-                                    )
-                            else:
-                                with open(file_path, 'rb') as video_file:
-                                    await query.message.reply_video(
-                                        video_file,
-                                        caption=f"{i+1:02d} - YouTube Playlist - {quality.upper()} Quality"
-                                    )
-                            
-                            # Clean up the file
-                            os.remove(file_path)
-                            
-                            # Small delay to avoid flooding
-                            await asyncio.sleep(0.5)
-                            
-                        except Exception as e:
-                            logger.error(f"Error sending playlist file {file_path}: {e}")
-                            continue
-                
-                await query.message.reply_text(f"🎉 Playlist {type_text.lower()} download completed!")
+            if progress:
+                # The listing is cached from when the URL was analyzed
+                info = await self.downloader.get_video_info(job['url'])
+                progress.items_total = len(info.get('entries') or []) if info else 0
+            
+            # Items uploaded before, or being downloaded for someone else right now,
+            # are delivered by file_id instead of being downloaded again
+            deferred_ids = set()
+            
+            def needs_download(entry):
+                video_id = entry.get('id')
+                # Only a check: delivering the item looks it up again
+                if self.file_id_cache.peek(video_id, download_type, quality) or (video_id, download_type, quality) in self.inflight:
+                    deferred_ids.add(video_id)
+                    return False
+                return True
+            
+            downloads = self.downloader.iter_playlist_downloads(
+                job['url'], download_type, quality, should_download=needs_download, owner=user_id, progress=progress
+            )
+            try:
+                async for i, entry, download in downloads:
+                    video_id = entry.get('id')
+                    # Items too large in the chosen quality come in a smaller one
+                    file_path, item_quality = download or (None, quality)
+                    if download_type == 'audio':
+                        send_kwargs = {'title': f"{i+1:02d}_{entry.get('title', 'Audio')}", 'performer': "YouTube Playlist"}
+                    else:
+                        send_kwargs = {'caption': f"{i+1:02d} - YouTube Playlist - {item_quality.upper()} Quality"}
+                    
+                    if file_path is None and video_id in deferred_ids:
+                        if await self._deliver_video(chat_id, entry.get('url'), video_id, download_type, quality, send_kwargs, user_id):
+                            sent_count += 1
+                            if progress:
+                                progress.items_done = sent_count
+                        continue
+                    
+                    if not file_path or not os.path.exists(file_path):
+                        continue
+                    
+                    try:
+                        if progress:
+                            progress.set_stage(f"Uploading item {i+1}")
+                        await self._send_file(chat_id, file_path, video_id, download_type, item_quality, **send_kwargs)
+                        sent_count += 1
+                        if progress:
+                            progress.items_done = sent_count
+                            progress.set_stage(None)
+                        
+                        # Small delay to avoid flooding
+                        await asyncio.sleep(0.5)
+                        
+                    except Exception as e:
+                        logger.error(f"Error sending playlist file {file_path}: {e}")
+                    finally:
+                        # Remove each file right away so only the items in flight use disk
+                        self.downloader.remove_download(file_path)
+            finally:
+                # Closed right away, even on cancel, so items still downloading stop and leave no files
+                await downloads.aclose()
+            
+            if sent_count:
+                await self._edit_status(job, f"✅ Sent {sent_count} {type_text.lower()} files!")
+                await self.application.bot.send_message(chat_id, f"🎉 Playlist {type_text.lower()} download completed!")
             else:
-                await query.edit_message_text("❌ Playlist download failed. Please try again.")
+                self._fail(job, 'no_items', "no playlist items downloaded")
+                await self._edit_status(job, "❌ Playlist download failed. Please try again.")
                 
+        except (WorkerPoolFullError, StorageFullError) as e:
+            self._fail(job, 'busy', str(e))
+            await self._edit_status(job, BUSY_TEXT)
         except Exception as e:
             logger.error(f"Error downloading playlist: {e}")
-            await query.edit_message_text(f"❌ Playlist download error: {str(e)}")
-        finally:
-            # Clean up user state
-            if user_id in self.user_states:
-                del self.user_states[user_id]
+            self._fail(job, 'error', str(e))
+            await self._edit_status(job, f"❌ Playlist download error: {str(e)}")
     
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Log Errors caused by Updates."""
         logger.warning('Update "%s" caused error "%s"', update, context.error)
     
-    def run(self):
-        """Start the bot."""
-        # Create the Application
-        application = Application.builder().token(BOT_TOKEN).build()
+    async def post_init(self, application: Application):
+        """Start the metrics endpoint, job scheduler and background maintenance once the event loop is running."""
+        self.background_tasks.append(asyncio.create_task(self.downloader.preload()))
+        if METRICS_PORT:
+            self.background_tasks.append(asyncio.create_task(serve_metrics(METRICS_LISTEN, METRICS_PORT)))
+        if self.runs_jobs:
+            self.background_tasks += [
+                asyncio.create_task(self.downloader.storage.run()),
+                asyncio.create_task(self.scheduler.run()),
+            ]
         
-        # Add handlers
+        # Updates and jobs are taken from here on
+        startup = time.monotonic() - STARTED_AT
+        STARTUP_SECONDS.set(startup)
+        logger.info(f"Started in {startup:.2f}s", extra={'startup_seconds': round(startup, 3)})
+    
+    async def post_shutdown(self, application: Application):
+        """Stop background tasks. Jobs still running are requeued on the next start."""
+        for task in self.background_tasks:
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+    
+    def build_application(self) -> Application:
+        """Create the Application, talking to a self-hosted Bot API server if one is configured."""
+        validate_config()
+        builder = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+        )
+        if BOT_API_URL:
+            # Self-hosted Bot API server; log the bot out of api.telegram.org before switching
+            api_url = BOT_API_URL.rstrip('/')
+            builder = (
+                builder
+                .base_url(f"{api_url}/bot")
+                .base_file_url(f"{api_url}/file/bot")
+                .local_mode(BOT_API_LOCAL_MODE)
+            )
+            logger.info(f"Using Bot API server at {api_url} (local mode: {BOT_API_LOCAL_MODE})")
+        application = self.application = builder.build()
+        return application
+    
+    async def run_worker(self):
+        """Run queued jobs without receiving updates; several workers can share one queue."""
+        application = self.build_application()
+        async with application:
+            await self.post_init(application)
+            logger.info(f"Download worker {self.scheduler.worker} started")
+            try:
+                await asyncio.gather(*self.background_tasks)
+            finally:
+                await self.post_shutdown(application)
+                self.downloader.shutdown()
+    
+    def add_handlers(self, application: Application):
+        """Register the command, message and button handlers."""
         application.add_handler(CommandHandler("start", self.start))
         application.add_handler(CommandHandler("help", self.help_command))
         application.add_handler(CommandHandler("quality", self.quality_command))
@@ -442,10 +936,29 @@ I can help you download audio or video from YouTube videos and playlists.
         
         # Handle errors
         application.add_error_handler(self.error_handler)
+    
+    def run(self):
+        """Start the bot."""
+        application = self.build_application()
+        self.add_handlers(application)
         
         # Start the bot
-        logger.info("Starting YouTube Downloader Bot...")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Starting YouTube Downloader Bot ({BOT_MODE} mode, {'running' if self.runs_jobs else 'queueing'} jobs)...")
+        try:
+            if BOT_MODE == 'webhook':
+                # Every replica registers the same URL and secret, so they can share a load balancer
+                application.run_webhook(
+                    listen=WEBHOOK_LISTEN,
+                    port=WEBHOOK_PORT,
+                    url_path=WEBHOOK_PATH,
+                    webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=ALLOWED_UPDATES
+                )
+            else:
+                application.run_polling(allowed_updates=ALLOWED_UPDATES)
+        finally:
+            self.downloader.shutdown()
 
 def main():
     """Main function to run the bot."""
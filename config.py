@@ -1,20 +1,82 @@
 import os
+import socket
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
 # Bot Configuration
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-if not BOT_TOKEN:
-    raise ValueError("BOT_TOKEN environment variable is required")
+# Checked by validate_config() when the bot starts, so tools and tests can import this module without it
+BOT_TOKEN = os.getenv('BOT_TOKEN', '')
 
 # Download Configuration
 DOWNLOAD_PATH = os.getenv('DOWNLOAD_PATH', './downloads')
-# Removed file size limit to allow larger files
+DATA_PATH = os.getenv('DATA_PATH', './data')  # Persistent bot state (caches, queues)
+# Update delivery: 'polling' (default) or 'webhook'. In webhook mode Telegram posts
+# updates to WEBHOOK_URL/WEBHOOK_PATH and the bot listens on WEBHOOK_LISTEN:WEBHOOK_PORT,
+# accepting only requests that carry WEBHOOK_SECRET.
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # Public base URL, e.g. https://bot.example.com
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # 1-256 characters: A-Z, a-z, 0-9, _ and -
+
+# Worker mode: bot.py only queues jobs and `python worker.py` processes run them.
+# Workers share JOB_QUEUE_PATH and the other files in DATA_PATH, so on several hosts
+# DATA_PATH must be on a filesystem with working SQLite locking.
+WORKER_MODE = os.getenv('WORKER_MODE', 'false').lower() == 'true'
+WORKER_POLL_INTERVAL = float(os.getenv('WORKER_POLL_INTERVAL', '1'))  # Seconds between checks for new jobs
+WORKER_TIMEOUT = int(os.getenv('WORKER_TIMEOUT', '60'))  # Seconds without a heartbeat before a worker's jobs are requeued
+
+# Seconds between progress edits of a job's status message. Telegram allows about
+# one edit per second per chat and 20 per minute in groups, so keep this at 3 or more.
+PROGRESS_UPDATE_INTERVAL = float(os.getenv('PROGRESS_UPDATE_INTERVAL', '3'))
+
+# Prometheus metrics at http://METRICS_LISTEN:METRICS_PORT/metrics; 0 turns them off.
+# Every process (bot and each worker) needs its own port.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+
+# Logging: 'text' or 'json' (one object per line). Lines written for a job carry its
+# job ID and a trace ID (chat:status message) that follows the URL from the first reply.
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+# Per-job profiling: a cProfile file and a tracemalloc snapshot for every job, written
+# to PROFILE_PATH as job-<id>.prof and job-<id>.tracemalloc. Slows jobs down; off by default.
+PROFILE_JOBS = os.getenv('PROFILE_JOBS', 'false').lower() == 'true'
+PROFILE_PATH = os.getenv('PROFILE_PATH', os.path.join(DATA_PATH, 'profiles'))
+
+# Session store for the steps between sending a URL and picking a quality:
+# 'memory' (single process), 'sqlite' (processes sharing DATA_PATH) or a redis:// URL
+SESSION_STORE = os.getenv('SESSION_STORE', 'memory')
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', os.path.join(DATA_PATH, 'sessions.sqlite3'))
+SESSION_TTL = int(os.getenv('SESSION_TTL', '3600'))  # Seconds before unused buttons expire
+
+# Name of this bot process, unique per replica; jobs it was running are requeued when it restarts
+INSTANCE_NAME = os.getenv('INSTANCE_NAME', socket.gethostname())
+
+# Optional self-hosted Bot API server (telegram-bot-api) instead of api.telegram.org.
+# In local mode the server reads uploads straight from DOWNLOAD_PATH by file:// path,
+# so it must see the files at the same location, and files up to 2000 MB are accepted.
+BOT_API_URL = os.getenv('BOT_API_URL', '')  # e.g. http://localhost:8081, empty for the cloud API
+BOT_API_LOCAL_MODE = os.getenv('BOT_API_LOCAL_MODE', 'true' if BOT_API_URL else 'false').lower() == 'true'
+
+# Largest file the bot may upload. The cloud Bot API accepts 50 MB, a local server 2000 MB.
+TELEGRAM_UPLOAD_LIMIT_MB = int(os.getenv('TELEGRAM_UPLOAD_LIMIT_MB', '2000' if BOT_API_LOCAL_MODE else '50'))
+UPLOAD_TIMEOUT = int(os.getenv('UPLOAD_TIMEOUT', '600'))  # Seconds to wait for an upload to be accepted
+# Files over the limit are cut into parts with ffmpeg (stream copy) instead of failing
+SPLIT_OVERSIZED = os.getenv('SPLIT_OVERSIZED', 'true').lower() == 'true'
+UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', '3'))  # Parts of one file uploaded at once
 SUPPORTED_AUDIO_FORMATS = ['mp3', 'm4a', 'opus', 'wav']
 SUPPORTED_VIDEO_FORMATS = ['mp4', 'webm', 'mkv']
 
+# Audio output format: 'mp3' (always transcoded), 'm4a' or 'opus' (stream copy when
+# the source codec matches, transcode otherwise) or 'native' (no ffmpeg at all)
+AUDIO_OUTPUT_FORMAT = os.getenv('AUDIO_OUTPUT_FORMAT', 'mp3')
+AUDIO_MP3_BITRATE = os.getenv('AUDIO_MP3_BITRATE', '192')  # kbps, only used for mp3
+
 # Quality presets for audio
 AUDIO_QUALITY_PRESETS = {
     'best': 'bestaudio/best',
@@ -42,3 +104,51 @@ VIDEO_QUALITY_ALTERNATIVES = {
 
 # Playlist settings
 MAX_PLAYLIST_ITEMS = 20  # Maximum items to process from a playlist
+PLAYLIST_PAGE_SIZE = int(os.getenv('PLAYLIST_PAGE_SIZE', '50'))  # Entries listed per flat extraction
+PLAYLIST_CONCURRENCY = int(os.getenv('PLAYLIST_CONCURRENCY', '3'))  # Items of one playlist downloaded at once
+
+# Worker pool settings
+# yt-dlp calls are blocking, so they run in a pool instead of on the event loop.
+# DOWNLOAD_EXECUTOR may be 'thread' or 'process'.
+DOWNLOAD_EXECUTOR = os.getenv('DOWNLOAD_EXECUTOR', 'thread')
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', '4'))  # Concurrent metadata extractions
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '3'))  # Concurrent downloads
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', '50'))  # Calls allowed to wait per pool
+# Idle yt-dlp instances each process keeps for reuse, so calls skip yt-dlp's setup and keep
+# their HTTP connections open. 0 creates a fresh one for every call.
+YDL_POOL_SIZE = int(os.getenv('YDL_POOL_SIZE', str(EXTRACT_WORKERS + DOWNLOAD_WORKERS)))
+
+# Metadata cache settings
+# extract_info results are reused across handlers and users until they expire.
+# Keep the TTL well below YouTube's format URL lifetime (a few hours).
+METADATA_CACHE_SIZE = int(os.getenv('METADATA_CACHE_SIZE', '256'))  # Max cached URLs
+METADATA_CACHE_TTL = int(os.getenv('METADATA_CACHE_TTL', '1800'))  # Seconds
+
+# Telegram file_id cache
+# Files uploaded once are re-sent by file_id instead of being downloaded again.
+FILE_ID_CACHE_PATH = os.getenv('FILE_ID_CACHE_PATH', os.path.join(DATA_PATH, 'file_ids.sqlite3'))
+
+# Download storage settings
+DOWNLOAD_QUOTA_MB = int(os.getenv('DOWNLOAD_QUOTA_MB', '10240'))  # 0 disables the quota
+DOWNLOAD_MAX_AGE = int(os.getenv('DOWNLOAD_MAX_AGE', '3600'))  # Seconds before stale files are evicted
+STORAGE_GC_INTERVAL = int(os.getenv('STORAGE_GC_INTERVAL', '300'))  # Seconds between background sweeps
+
+# Users allowed to clean up everyone's finished downloads with /cleanup
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()}
+
+# Job queue settings
+# Downloads are queued in SQLite and started fairly across users; cheap audio jobs
+# go ahead of heavy 4K video, and waiting jobs slowly gain priority.
+JOB_QUEUE_PATH = os.getenv('JOB_QUEUE_PATH', os.path.join(DATA_PATH, 'jobs.sqlite3'))
+MAX_CONCURRENT_JOBS = int(os.getenv('MAX_CONCURRENT_JOBS', '4'))  # Jobs running at once, across all users
+MAX_JOBS_PER_USER = int(os.getenv('MAX_JOBS_PER_USER', '1'))  # Jobs running at once for one user
+MAX_PENDING_PER_USER = int(os.getenv('MAX_PENDING_PER_USER', '5'))  # Jobs one user may have waiting
+JOB_AGING_SECONDS = int(os.getenv('JOB_AGING_SECONDS', '120'))  # Waiting this long moves a job up one class
+
+
+def validate_config():
+    """Raise ValueError for settings the bot can't start without"""
+    if not BOT_TOKEN:
+        raise ValueError("BOT_TOKEN environment variable is required")
+    if BOT_MODE == 'webhook' and (not WEBHOOK_URL or not WEBHOOK_SECRET):
+        raise ValueError("WEBHOOK_URL and WEBHOOK_SECRET are required in webhook mode")
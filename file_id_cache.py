@@ -0,0 +1,97 @@
+import os
+import sqlite3
+import time
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class FileIdCache:
+    """Persistent map from (video ID, download type, quality) to a Telegram file_id.
+
+    Telegram lets a bot re-send any file it has uploaded before by file_id, so a
+    cache hit skips both the download and the upload.
+    """
+
+    def __init__(self, db_path: str):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS file_ids (
+                video_id TEXT NOT NULL,
+                download_type TEXT NOT NULL,
+                quality TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                media_type TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (video_id, download_type, quality)
+            )
+            """
+        )
+        self._conn.commit()
+
+    def get(self, video_id: str, download_type: str, quality: str) -> Optional[Tuple[str, str]]:
+        """Return (file_id, media_type) for a previously uploaded file, if any"""
+        if not video_id:
+            return None
+
+        cached = self.peek(video_id, download_type, quality)
+        if cached is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cached
+
+    def peek(self, video_id: str, download_type: str, quality: str) -> Optional[Tuple[str, str]]:
+        """Like get(), but not counted as a hit or miss: for checks that don't serve a request"""
+        if not video_id:
+            return None
+
+        row = self._conn.execute(
+            "SELECT file_id, media_type FROM file_ids WHERE video_id = ? AND download_type = ? AND quality = ?",
+            (video_id, download_type, quality)
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def set(self, video_id: str, download_type: str, quality: str, file_id: str, media_type: str):
+        """Remember the file_id Telegram returned for an upload"""
+        if not video_id or not file_id:
+            return
+
+        self._conn.execute(
+            "INSERT OR REPLACE INTO file_ids (video_id, download_type, quality, file_id, media_type, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (video_id, download_type, quality, file_id, media_type, time.time())
+        )
+        self._conn.commit()
+
+    def invalidate(self, video_id: str, download_type: str, quality: str):
+        """Forget a file_id, e.g. after Telegram rejected it as stale"""
+        self._conn.execute(
+            "DELETE FROM file_ids WHERE video_id = ? AND download_type = ? AND quality = ?",
+            (video_id, download_type, quality)
+        )
+        self._conn.commit()
+        logger.info(f"Invalidated cached file_id for {video_id} ({download_type}/{quality})")
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters for logging and monitoring"""
+        lookups = self.hits + self.misses
+        size = self._conn.execute("SELECT COUNT(*) FROM file_ids").fetchone()[0]
+        return {
+            'size': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        """Close the database connection"""
+        self._conn.close()
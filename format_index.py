@@ -0,0 +1,176 @@
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Nominal resolution of each video quality preset (the short side of the frame)
+VIDEO_QUALITY_HEIGHTS = {
+    '4k': 2160,
+    '2k': 1440,
+    '1080p': 1080,
+    '720p': 720,
+    '480p': 480,
+    '360p': 360,
+}
+
+# Highest audio bitrate (kbps) each audio quality preset accepts; None means no cap
+AUDIO_QUALITY_BITRATES = {
+    'best': None,
+    'high': None,
+    'medium': 128,
+    'low': 64,
+}
+
+
+def _estimate_size(fmt: Dict, duration: Optional[float]) -> Optional[int]:
+    """Size in bytes as reported by YouTube, or estimated from the bitrate"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return int(size)
+    bitrate = fmt.get('tbr') or fmt.get('abr')  # kbps
+    if bitrate and duration:
+        return int(bitrate * 1000 / 8 * duration)
+    return None
+
+
+def build_format_index(info: Dict) -> Dict:
+    """Reduce an extract_info result to what quality selection needs.
+
+    Only the fields used to build the quality menu and to pick exact
+    format_ids are kept, so the index is small enough to cache freely.
+    """
+    duration = info.get('duration')
+    video, audio = [], []
+
+    for fmt in info.get('formats') or []:
+        vcodec = fmt.get('vcodec') or 'none'
+        acodec = fmt.get('acodec') or 'none'
+        if not fmt.get('format_id') or (vcodec == 'none' and acodec == 'none'):
+            continue  # Storyboards and other non-media formats
+
+        entry = {
+            'format_id': fmt['format_id'],
+            'ext': fmt.get('ext'),
+            'vcodec': vcodec,
+            'acodec': acodec,
+            'filesize': _estimate_size(fmt, duration),
+        }
+        if vcodec != 'none':
+            height, width = fmt.get('height') or 0, fmt.get('width') or 0
+            # Portrait videos (Shorts) are labelled by their width, like YouTube does
+            entry['height'] = min(height, width) if height and width else height
+            entry['fps'] = fmt.get('fps')
+            entry['tbr'] = fmt.get('tbr') or 0
+            video.append(entry)
+        else:
+            entry['abr'] = fmt.get('abr') or fmt.get('tbr') or 0
+            audio.append(entry)
+
+    return {'id': info.get('id'), 'duration': duration, 'video': video, 'audio': audio}
+
+
+def available_qualities(index: Dict, download_type: str) -> List[str]:
+    """Quality presets the indexed video can actually deliver, best first"""
+    if download_type == 'audio':
+        bitrates = [fmt['abr'] for fmt in index['audio']]
+        if not bitrates:
+            # Only muxed formats: audio has to come out of one of those
+            return ['best'] if index['video'] else []
+        return [quality for quality, cap in AUDIO_QUALITY_BITRATES.items()
+                if cap is None or min(bitrates) <= cap]
+
+    max_height = max((fmt['height'] for fmt in index['video']), default=0)
+    if not max_height:
+        return []
+    qualities = [quality for quality, height in VIDEO_QUALITY_HEIGHTS.items() if height <= max_height]
+    # Always offer at least the smallest preset, even for tiny videos
+    return qualities or [list(VIDEO_QUALITY_HEIGHTS)[-1]]
+
+
+def _codec_matches(codec: str, preferred: Optional[str]) -> bool:
+    if not preferred:
+        return False
+    if preferred == 'h264':
+        return codec.startswith(('avc1', 'h264'))
+    if preferred == 'aac':
+        return codec.startswith(('mp4a', 'aac'))
+    return codec.startswith(preferred)
+
+
+def _pick_audio(index: Dict, quality: str, preferred_acodec: Optional[str]) -> Optional[Dict]:
+    """Best audio-only format within the bitrate cap of a quality preset"""
+    if not index['audio']:
+        return None
+
+    cap = AUDIO_QUALITY_BITRATES.get(quality)
+    within = [fmt for fmt in index['audio'] if cap is None or fmt['abr'] <= cap]
+    if not within:
+        # Nothing small enough: take the smallest there is
+        return min(index['audio'], key=lambda fmt: fmt['abr'])
+
+    # A codec that can be stream-copied beats a slightly higher bitrate
+    return max(within, key=lambda fmt: (_codec_matches(fmt['acodec'], preferred_acodec), fmt['abr']))
+
+
+def select_format(index: Dict, download_type: str, quality: str,
+                  preferred_vcodec: Optional[str] = 'h264', preferred_acodec: Optional[str] = None) -> Optional[Dict]:
+    """Pick exact format_ids for a quality preset.
+
+    Returns {'format_id', 'height', 'filesize'} where format_id is a yt-dlp
+    format spec ("137+140" or a single ID) and filesize is the estimated size
+    of the result, or None if the index has nothing suitable.
+    """
+    if download_type == 'audio':
+        fmt = _pick_audio(index, quality, preferred_acodec)
+        if fmt is None:
+            # No audio-only streams: extract the audio from a muxed format
+            muxed = [fmt for fmt in index['video'] if fmt['acodec'] != 'none']
+            if not muxed:
+                return None
+            fmt = max(muxed, key=lambda fmt: fmt['tbr'])
+        return {'format_id': fmt['format_id'], 'height': None, 'filesize': fmt['filesize']}
+
+    if not index['video']:
+        return None
+
+    target = VIDEO_QUALITY_HEIGHTS.get(quality, VIDEO_QUALITY_HEIGHTS['1080p'])
+    fitting = [fmt for fmt in index['video'] if fmt['height'] <= target]
+    if not fitting:
+        # Every format is bigger than asked for: take the smallest resolution
+        lowest = min(fmt['height'] for fmt in index['video'])
+        fitting = [fmt for fmt in index['video'] if fmt['height'] == lowest]
+
+    video = max(fitting, key=lambda fmt: (
+        fmt['height'],
+        _codec_matches(fmt['vcodec'], preferred_vcodec),
+        fmt['tbr'],
+    ))
+
+    if video['acodec'] != 'none':
+        return {'format_id': video['format_id'], 'height': video['height'], 'filesize': video['filesize']}
+
+    audio = _pick_audio(index, 'best', preferred_acodec or 'aac')
+    if audio is None:
+        return {'format_id': video['format_id'], 'height': video['height'], 'filesize': video['filesize']}
+
+    filesize = video['filesize'] + audio['filesize'] if video['filesize'] and audio['filesize'] else None
+    return {'format_id': f"{video['format_id']}+{audio['format_id']}", 'height': video['height'], 'filesize': filesize}
+
+
+def select_format_within(index: Dict, download_type: str, quality: str, max_filesize: Optional[int],
+                         estimate: Callable[[Dict], Optional[int]] = None, **preferences) -> Optional[Tuple[str, Dict]]:
+    """Pick the best selection at or below quality whose estimated size fits max_filesize.
+
+    Lower presets are tried in order; a selection of unknown size is accepted
+    since there is nothing to compare. estimate(selection) may override the
+    size, e.g. for output that is transcoded. Returns (quality, selection), or
+    None when even the smallest preset is too large.
+    """
+    presets = list(AUDIO_QUALITY_BITRATES if download_type == 'audio' else VIDEO_QUALITY_HEIGHTS)
+    start = presets.index(quality) if quality in presets else 0
+
+    for candidate in presets[start:]:
+        selection = select_format(index, download_type, candidate, **preferences)
+        if selection is None:
+            continue
+        size = estimate(selection) if estimate else selection['filesize']
+        if not max_filesize or size is None or size <= max_filesize:
+            return candidate, dict(selection, filesize=size)
+    return None
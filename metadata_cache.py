@@ -0,0 +1,99 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+
+def canonical_key(url: str) -> str:
+    """Build a cache key from the video or playlist ID in a YouTube URL.
+
+    Falls back to the stripped URL when no ID can be found, so unusual links
+    still cache correctly, just without sharing entries with other spellings.
+    """
+    parsed = urlparse(url.strip())
+    query = parse_qs(parsed.query)
+
+    # Links carrying a list= parameter are treated as playlists, like yt-dlp does
+    if query.get('list'):
+        return f"playlist:{query['list'][0]}"
+
+    if query.get('v'):
+        return f"video:{query['v'][0]}"
+
+    host = (parsed.hostname or '').lower()
+    parts = [part for part in parsed.path.split('/') if part]
+    if host.endswith('youtu.be') and parts:
+        return f"video:{parts[0]}"
+    if len(parts) >= 2 and parts[0] in ('shorts', 'embed', 'live', 'v'):
+        return f"video:{parts[1]}"
+
+    return f"url:{url.strip()}"
+
+
+def video_key(video_id: str) -> str:
+    """Cache key for a bare video ID"""
+    return f"video:{video_id}"
+
+
+class MetadataCache:
+    """Size-bounded LRU cache with per-entry TTL for extract_info results"""
+
+    def __init__(self, max_entries: int = 256, ttl: float = 1800):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return a cached value, or None if it is missing or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """Store a value, evicting the least recently used entries if needed"""
+        if self.max_entries <= 0:
+            return
+
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: str):
+        """Drop a single entry"""
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop every entry"""
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters for logging and monitoring"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,226 @@
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from cache-speed lookups to long playlist uploads
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(pairs: Sequence[Tuple[str, str]]) -> str:
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """A named metric with optional labels, rendered in the Prometheus text format"""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set_function(self, func: Callable[[], float], **labels):
+        """Report func() at scrape time, for values another object already keeps; None means no sample yet"""
+        with self._lock:
+            self._functions[self._key(labels)] = func
+
+    def _samples(self) -> List[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, func in functions.items():
+            try:
+                value = func()
+            except Exception as e:
+                logger.debug(f"Could not collect {self.name}: {e}")
+                continue
+            if value is not None:
+                values[key] = value
+        return [('', tuple(zip(self.labelnames, key)), value) for key, value in sorted(values.items())]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. bytes moved or failed jobs"""
+
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, e.g. jobs waiting in the queue"""
+
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g. how long each stage of a job took"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._observations: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._observations.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._observations[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the with block took"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            observations = {key: (list(counts), total) for key, (counts, total) in self._observations.items()}
+        samples = []
+        for key, (counts, total) in sorted(observations.items()):
+            labels = tuple(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, counts):
+                samples.append(('_bucket', labels + (('le', _format_value(bound)),), count))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, counts[-1]))
+        return samples
+
+
+class MetricsRegistry:
+    """All metrics of this process, rendered together for /metrics"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'ytbot_stage_seconds', 'Time spent in each stage of a job: extract, download, postprocess, split, upload', ['stage']
+)
+POOL_WAIT_SECONDS = REGISTRY.histogram('ytbot_pool_wait_seconds', 'Time calls waited for a free worker', ['pool'])
+QUEUE_WAIT_SECONDS = REGISTRY.histogram('ytbot_queue_wait_seconds', 'Time jobs waited in the queue before starting')
+JOB_SECONDS = REGISTRY.histogram('ytbot_job_seconds', 'Time from a job starting to its final status')
+BYTES = REGISTRY.counter('ytbot_bytes_total', 'Bytes downloaded from YouTube and uploaded to Telegram', ['direction'])
+JOBS = REGISTRY.counter('ytbot_jobs_total', 'Finished jobs by final status', ['status'])
+JOB_FAILURES = REGISTRY.counter('ytbot_job_failures_total', 'Failed jobs by reason', ['reason'])
+CACHE_HITS = REGISTRY.counter('ytbot_cache_hits_total', 'Cache lookups that found an entry', ['cache'])
+CACHE_MISSES = REGISTRY.counter('ytbot_cache_misses_total', 'Cache lookups that found nothing', ['cache'])
+QUEUE_DEPTH = REGISTRY.gauge('ytbot_queue_depth', 'Jobs waiting in the queue')
+ACTIVE_JOBS = REGISTRY.gauge('ytbot_active_jobs', 'Jobs running in this process')
+POOL_ACTIVE = REGISTRY.gauge('ytbot_pool_active', 'Calls running in each worker pool', ['pool'])
+POOL_QUEUED = REGISTRY.gauge('ytbot_pool_queued', 'Calls waiting for a free worker in each pool', ['pool'])
+DISK_USAGE = REGISTRY.gauge('ytbot_download_dir_bytes', 'Disk space used by the download directory at the last storage sweep')
+STARTUP_SECONDS = REGISTRY.gauge('ytbot_startup_seconds', 'Time from importing the bot to taking updates or jobs')
+
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, registry: MetricsRegistry):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+        # Headers are not needed, but have to be read before answering
+        while (await asyncio.wait_for(reader.readline(), timeout=10)) not in (b'\r\n', b'\n', b''):
+            pass
+
+        parts = request_line.decode('latin-1').split()
+        path = parts[1].split('?')[0] if len(parts) > 1 else ''
+        if path == '/metrics':
+            status, content_type, body = '200 OK', 'text/plain; version=0.0.4; charset=utf-8', registry.render().encode()
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain; charset=utf-8', b'Not found\n'
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(host: str, port: int, registry: MetricsRegistry = REGISTRY):
+    """Serve the registry at http://host:port/metrics until cancelled"""
+    try:
+        server = await asyncio.start_server(lambda r, w: _handle_request(r, w, registry), host, port)
+    except OSError as e:
+        # Metrics are not worth stopping the bot for, e.g. when two workers share a port
+        logger.error(f"Could not serve metrics on {host}:{port}: {e}")
+        return
+
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    async with server:
+        await server.serve_forever()
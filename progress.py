@@ -0,0 +1,180 @@
+import os
+import time
+import threading
+from typing import Dict, Optional
+
+# Friendlier names for the yt-dlp post-processors the bot uses
+POSTPROCESSOR_NAMES = {
+    'ExtractAudio': 'Converting audio',
+    'Merger': 'Merging video and audio',
+    'VideoRemuxer': 'Remuxing to MP4',
+    'MoveFiles': 'Finishing',
+}
+
+
+class DownloadCancelled(Exception):
+    """Raised inside yt-dlp (and other blocking work) once a job has been cancelled"""
+
+
+class CancelFlag:
+    """Cancellation for work running in another process, e.g. a process pool.
+
+    The flag is a file that exists once set, so unlike a DownloadProgress or a
+    threading.Event it can be pickled and is seen by every process. Its hooks
+    stop a yt-dlp download the way DownloadProgress's do, and is_set can be
+    passed as should_stop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def set(self):
+        open(self.path, 'a').close()
+
+    def is_set(self) -> bool:
+        return os.path.exists(self.path)
+
+    @property
+    def cancelled(self) -> bool:
+        """Same as is_set(), named like DownloadProgress.cancelled"""
+        return self.is_set()
+
+    def hook(self, d: Dict):
+        """yt-dlp progress hook"""
+        if self.is_set():
+            raise DownloadCancelled("Download cancelled")
+
+    def postprocessor_hook(self, d: Dict):
+        """yt-dlp post-processor hook"""
+        if d.get('status') == 'started' and self.is_set():
+            raise DownloadCancelled("Download cancelled")
+
+
+def _format_bytes(size: float) -> str:
+    if size < 1024 * 1024:
+        return f"{size / 1024:.0f} KB"
+    if size < 1024 * 1024 * 1024:
+        return f"{size / (1024 * 1024):.1f} MB"
+    return f"{size / (1024 * 1024 * 1024):.2f} GB"
+
+
+def _format_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+class DownloadProgress:
+    """Latest progress of one job, fed by yt-dlp hooks from worker threads.
+
+    Hooks fire many times a second; they only overwrite the current state, and
+    readers take a snapshot whenever they want to show it. Several files
+    (e.g. the video and audio streams, or playlist items downloading side by
+    side) are tracked separately and summed.
+
+    It also carries the job's cancellation: once cancel() is called, the next
+    hook raises DownloadCancelled, which aborts the download in its worker
+    thread before any further data or post-processing.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files: Dict[str, Dict] = {}
+        self.stage: Optional[str] = None
+        self.items_done = 0
+        self.items_total = 0
+        self.updated_at = time.monotonic()
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """Make the downloads reporting here stop at their next hook"""
+        self._cancelled.set()
+
+    def hook(self, d: Dict):
+        """yt-dlp progress hook"""
+        if self.cancelled:
+            raise DownloadCancelled("Download cancelled")
+        key = d.get('filename') or d.get('tmpfilename') or ''
+        with self._lock:
+            if d.get('status') == 'downloading':
+                self._files[key] = {
+                    'downloaded': d.get('downloaded_bytes') or 0,
+                    'total': d.get('total_bytes') or d.get('total_bytes_estimate') or 0,
+                    'speed': d.get('speed') or 0,
+                    'eta': d.get('eta'),
+                }
+                self.stage = None
+            elif d.get('status') == 'finished':
+                total = d.get('total_bytes') or d.get('downloaded_bytes') or 0
+                self._files[key] = {'downloaded': total, 'total': total, 'speed': 0, 'eta': 0}
+            self.updated_at = time.monotonic()
+
+    def postprocessor_hook(self, d: Dict):
+        """yt-dlp post-processor hook"""
+        if self.cancelled and d.get('status') == 'started':
+            raise DownloadCancelled("Download cancelled")
+        with self._lock:
+            if d.get('status') == 'started':
+                name = d.get('postprocessor', '')
+                self.stage = POSTPROCESSOR_NAMES.get(name, name)
+            self.updated_at = time.monotonic()
+
+    def set_stage(self, stage: Optional[str]):
+        """Show a stage of the job outside yt-dlp, e.g. uploading"""
+        with self._lock:
+            self.stage = stage
+            self.updated_at = time.monotonic()
+
+    def snapshot(self) -> Dict:
+        """Current totals across all tracked files"""
+        with self._lock:
+            files = list(self._files.values())
+            stage = self.stage
+
+        downloaded = sum(f['downloaded'] for f in files)
+        total = sum(f['total'] for f in files)
+        speed = sum(f['speed'] for f in files)
+        etas = [f['eta'] for f in files if f['eta']]
+        return {
+            'downloaded': downloaded,
+            'total': total,
+            'speed': speed,
+            'eta': max(etas) if etas else None,
+            'stage': stage,
+            'items_done': self.items_done,
+            'items_total': self.items_total,
+        }
+
+    def render(self) -> str:
+        """One or two lines describing the progress, empty before anything happened"""
+        state = self.snapshot()
+        lines = []
+
+        if state['items_total']:
+            lines.append(f"📦 {state['items_done']}/{state['items_total']} items sent")
+        elif state['items_done']:
+            lines.append(f"📦 {state['items_done']} items sent")
+
+        if state['stage']:
+            lines.append(f"⚙️ {state['stage']}...")
+        elif state['downloaded']:
+            parts = []
+            if state['total']:
+                percent = min(100, state['downloaded'] * 100 / state['total'])
+                filled = int(percent // 10)
+                parts.append(f"{'▓' * filled}{'░' * (10 - filled)} {percent:.0f}%")
+                parts.append(f"{_format_bytes(state['downloaded'])} / {_format_bytes(state['total'])}")
+            else:
+                parts.append(_format_bytes(state['downloaded']))
+            if state['speed']:
+                parts.append(f"{_format_bytes(state['speed'])}/s")
+            if state['eta']:
+                parts.append(f"ETA {_format_eta(state['eta'])}")
+            lines.append(" · ".join(parts))
+
+        return "\n".join(lines)
@@ -0,0 +1,420 @@
+import os
+import time
+import math
+import asyncio
+import sqlite3
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from metrics import JOBS, JOB_FAILURES, JOB_SECONDS, QUEUE_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+JOB_FIELDS = (
+    'id', 'user_id', 'chat_id', 'message_id', 'url', 'video_id', 'title', 'is_playlist',
+    'split', 'download_type', 'quality', 'priority', 'status', 'worker', 'created_at', 'started_at',
+    'finished_at', 'error', 'result'
+)
+
+
+class QueueLimitError(Exception):
+    """Raised when a user already has the maximum number of pending jobs"""
+
+
+def job_priority(download_type: str, quality: str, is_playlist: bool) -> int:
+    """Cost class of a job: lower runs first. Audio is cheapest, 4K video the heaviest."""
+    if download_type == 'audio':
+        priority = 0
+    elif quality in ('4k', '2k'):
+        priority = 3
+    elif quality == '1080p':
+        priority = 2
+    else:
+        priority = 1
+    # A playlist is many downloads in one job
+    return priority + (1 if is_playlist else 0)
+
+
+def dispatch_order(pending: List[Dict], running_per_user: Dict[int, int], last_served: Dict[int, float],
+                   max_per_user: int, aging_seconds: float, now: float = None) -> List[Dict]:
+    """Order pending jobs the way the scheduler would start them.
+
+    Each user's cheapest job competes for the next slot. Jobs are compared by
+    cost class, which improves by one for every aging_seconds spent waiting so
+    heavy jobs can't starve. Within a class users take turns, starting with the
+    one served least recently. Users already running max_per_user jobs wait
+    until one of them finishes.
+    """
+    now = time.time() if now is None else now
+    running = dict(running_per_user)
+    served = dict(last_served)
+    queues: Dict[int, List[Dict]] = {}
+
+    for job in pending:
+        queues.setdefault(job['user_id'], []).append(job)
+
+    def effective_class(job: Dict) -> int:
+        waited = now - job['created_at']
+        return math.floor(job['priority'] - (waited / aging_seconds if aging_seconds > 0 else 0))
+
+    for jobs in queues.values():
+        jobs.sort(key=lambda job: (effective_class(job), job['created_at']))
+
+    order = []
+    while queues:
+        candidates = [
+            (effective_class(jobs[0]), served.get(user_id, 0), jobs[0]['created_at'], user_id)
+            for user_id, jobs in queues.items()
+            if max_per_user <= 0 or running.get(user_id, 0) < max_per_user
+        ]
+        if not candidates:
+            break
+
+        _, _, _, user_id = min(candidates)
+        job = queues[user_id].pop(0)
+        order.append(job)
+        running[user_id] = running.get(user_id, 0) + 1
+        served[user_id] = now + len(order)  # Later than anyone served before
+        if not queues[user_id]:
+            del queues[user_id]
+
+    return order
+
+
+class JobStore:
+    """SQLite-backed download queue, so pending jobs survive a restart"""
+
+    def __init__(self, db_path: str, max_per_user: int = 1, max_pending_per_user: int = 5, aging_seconds: float = 120):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.max_per_user = max_per_user
+        self.max_pending_per_user = max_pending_per_user
+        self.aging_seconds = aging_seconds
+        # Autocommit mode; claim_next manages its own transaction
+        self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER,
+                url TEXT NOT NULL,
+                video_id TEXT,
+                title TEXT,
+                is_playlist INTEGER NOT NULL DEFAULT 0,
+                split INTEGER NOT NULL DEFAULT 0,
+                download_type TEXT NOT NULL,
+                quality TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                worker TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                error TEXT,
+                result TEXT,
+                reported_position INTEGER
+            )
+            """
+        )
+        columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if 'split' not in columns:
+            # Queues created before split delivery existed
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN split INTEGER NOT NULL DEFAULT 0")
+        if 'reported_position' not in columns:
+            # Queues created before positions were shared between processes
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN reported_position INTEGER")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_turns (user_id INTEGER PRIMARY KEY, last_served REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS workers (name TEXT PRIMARY KEY, last_seen REAL NOT NULL)")
+
+    def enqueue(self, user_id: int, chat_id: int, message_id: Optional[int], url: str, download_type: str,
+                quality: str, is_playlist: bool = False, video_id: str = None, title: str = None,
+                split: bool = False) -> int:
+        """Add a job to the queue and return its ID.
+
+        split=True keeps the requested quality even if it exceeds the upload
+        limit; the result is then delivered in parts.
+        """
+        pending = self._conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE user_id = ? AND status = ?", (user_id, PENDING)
+        ).fetchone()[0]
+        if self.max_pending_per_user > 0 and pending >= self.max_pending_per_user:
+            raise QueueLimitError(f"User {user_id} already has {pending} pending jobs")
+
+        cursor = self._conn.execute(
+            "INSERT INTO jobs (user_id, chat_id, message_id, url, video_id, title, is_playlist, split, download_type, "
+            "quality, priority, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, chat_id, message_id, url, video_id, title, int(is_playlist), int(split), download_type, quality,
+             job_priority(download_type, quality, is_playlist), PENDING, time.time())
+        )
+        return cursor.lastrowid
+
+    def get(self, job_id: int) -> Optional[Dict]:
+        """Fetch a job by ID"""
+        row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def _pending_order(self) -> List[Dict]:
+        pending = [dict(row) for row in self._conn.execute("SELECT * FROM jobs WHERE status = ?", (PENDING,))]
+        running = {
+            row[0]: row[1] for row in
+            self._conn.execute("SELECT user_id, COUNT(*) FROM jobs WHERE status = ? GROUP BY user_id", (RUNNING,))
+        }
+        served = {row[0]: row[1] for row in self._conn.execute("SELECT user_id, last_served FROM user_turns")}
+        return dispatch_order(pending, running, served, self.max_per_user, self.aging_seconds)
+
+    def claim_next(self, worker: str) -> Optional[Dict]:
+        """Atomically pick the next job to run and mark it as running"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            order = self._pending_order()
+            if not order:
+                self._conn.execute("COMMIT")
+                return None
+
+            job = order[0]
+            now = time.time()
+            # Its message stops showing a position; if it is ever requeued, the next one is reported again
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, worker = ?, started_at = ?, reported_position = NULL WHERE id = ?",
+                (RUNNING, worker, now, job['id'])
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO user_turns (user_id, last_served) VALUES (?, ?)", (job['user_id'], now)
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+        job.update(status=RUNNING, worker=worker, started_at=now)
+        return job
+
+    def finish(self, job_id: int, status: str = DONE, error: str = None, result: str = None):
+        """Record the outcome of a job; a cancelled job stays cancelled"""
+        self._conn.execute(
+            "UPDATE jobs SET status = ?, finished_at = ?, error = ?, result = ? WHERE id = ? AND status != ?",
+            (status, time.time(), error, result, job_id, CANCELLED)
+        )
+
+    def cancel(self, job_id: int) -> Optional[str]:
+        """Mark a pending or running job as cancelled.
+
+        Returns the status the job had, or None if it had already finished.
+        Whoever runs the job notices the change and stops it.
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row[0] not in (PENDING, RUNNING):
+                self._conn.execute("COMMIT")
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ?", (CANCELLED, time.time(), job_id)
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return row[0]
+
+    def positions(self) -> Dict[int, int]:
+        """Map each pending job ID to its 1-based place in the dispatch order"""
+        order = self._pending_order()
+        positions = {job['id']: index + 1 for index, job in enumerate(order)}
+        # Jobs blocked by the per-user limit come after everything that can start
+        for row in self._conn.execute("SELECT id FROM jobs WHERE status = ? ORDER BY created_at", (PENDING,)):
+            positions.setdefault(row[0], len(positions) + 1)
+        return positions
+
+    def record_position(self, job_id: int, position: int) -> bool:
+        """Record the queue position shown to a pending job's user.
+
+        Returns False if that position was already recorded, by this process
+        or any other sharing the queue, so each change is reported only once.
+        """
+        cursor = self._conn.execute(
+            "UPDATE jobs SET reported_position = ? WHERE id = ? AND status = ? "
+            "AND (reported_position IS NULL OR reported_position != ?)",
+            (position, job_id, PENDING, position)
+        )
+        return cursor.rowcount > 0
+
+    def pending_jobs(self) -> List[Dict]:
+        """All pending jobs"""
+        return [dict(row) for row in self._conn.execute("SELECT * FROM jobs WHERE status = ?", (PENDING,))]
+
+    def count(self, status: str) -> int:
+        """Number of jobs in a given status"""
+        return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def requeue_running(self, worker: str = None) -> int:
+        """Put running jobs back in the queue, e.g. after a crash. Returns how many were requeued."""
+        if worker is None:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, worker = NULL, started_at = NULL WHERE status = ?", (PENDING, RUNNING)
+            )
+        else:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, worker = NULL, started_at = NULL WHERE status = ? AND worker = ?",
+                (PENDING, RUNNING, worker)
+            )
+        return cursor.rowcount
+
+    def heartbeat(self, worker: str):
+        """Record that a worker is alive"""
+        self._conn.execute(
+            "INSERT OR REPLACE INTO workers (name, last_seen) VALUES (?, ?)", (worker, time.time())
+        )
+
+    def requeue_stale(self, timeout: float) -> int:
+        """Requeue jobs held by workers that stopped sending heartbeats. Returns how many were requeued."""
+        cutoff = time.time() - timeout
+        cursor = self._conn.execute(
+            "UPDATE jobs SET status = ?, worker = NULL, started_at = NULL WHERE status = ? "
+            "AND (worker IS NULL OR worker NOT IN (SELECT name FROM workers WHERE last_seen >= ?))",
+            (PENDING, RUNNING, cutoff)
+        )
+        self._conn.execute("DELETE FROM workers WHERE last_seen < ?", (cutoff,))
+        return cursor.rowcount
+
+    def purge(self, older_than: float):
+        """Delete finished jobs older than the given number of seconds"""
+        self._conn.execute(
+            "DELETE FROM jobs WHERE status IN (?, ?, ?) AND finished_at < ?",
+            (DONE, FAILED, CANCELLED, time.time() - older_than)
+        )
+
+    def close(self):
+        """Close the database connection"""
+        self._conn.close()
+
+
+class JobScheduler:
+    """Runs queued jobs in this process with bounded concurrency.
+
+    Several schedulers, in the bot or in separate worker processes, can share
+    one JobStore; each claims jobs under its own worker name and sends
+    heartbeats, and jobs held by a worker that stopped sending them for
+    worker_timeout seconds are put back in the queue.
+
+    runner(job) performs a job; on_queue_changed(positions) is called with the
+    new queue positions whenever jobs start, so waiting users can be told
+    where they stand. A running job that gets cancelled, here or from another
+    process, has its runner task cancelled.
+    """
+
+    def __init__(self, store: JobStore, runner: Callable[[Dict], Awaitable[None]], max_concurrent: int,
+                 worker: str = 'bot', on_queue_changed: Callable[[Dict[int, int]], Awaitable[None]] = None,
+                 poll_interval: float = 5.0, worker_timeout: float = 60.0):
+        self.store = store
+        self.runner = runner
+        self.max_concurrent = max(1, max_concurrent)
+        self.worker = worker
+        self.on_queue_changed = on_queue_changed
+        self.poll_interval = poll_interval
+        self.worker_timeout = worker_timeout
+        self.active: Dict[int, asyncio.Task] = {}
+        self._stopping = set()
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def submit(self, **job) -> int:
+        """Queue a job and return its ID. Call wake() once the user has been told about it."""
+        return self.store.enqueue(**job)
+
+    def position(self, job_id: int) -> Optional[int]:
+        """Current queue position of a pending job"""
+        return self.store.positions().get(job_id)
+
+    def cancel(self, job_id: int) -> Optional[str]:
+        """Cancel a job and stop it if it runs here. Returns the status it had, or None if it had finished."""
+        previous = self.store.cancel(job_id)
+        if previous is not None:
+            self._stop(job_id)
+        return previous
+
+    def _stop(self, job_id: int):
+        task = self.active.get(job_id)
+        # Cancelled once only, so a second cancel can't interrupt the runner's cleanup
+        if task and job_id not in self._stopping:
+            self._stopping.add(job_id)
+            task.cancel()
+
+    def wake(self):
+        """Ask the dispatcher to look for startable jobs now"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run_job(self, job: Dict):
+        QUEUE_WAIT_SECONDS.observe(job['started_at'] - job['created_at'])
+        try:
+            await self.runner(job)
+            # The runner may already have recorded a more specific outcome
+            current = self.store.get(job['id'])
+            if current and current['status'] == RUNNING:
+                self.store.finish(job['id'], DONE)
+        except Exception as e:
+            logger.error(f"Job {job['id']} failed: {e}")
+            JOB_FAILURES.inc(reason='error')
+            self.store.finish(job['id'], FAILED, error=str(e))
+        finally:
+            current = self.store.get(job['id'])
+            if current and current['status'] != RUNNING:
+                JOBS.inc(status=current['status'])
+            JOB_SECONDS.observe(time.time() - job['started_at'])
+            self.active.pop(job['id'], None)
+            self._stopping.discard(job['id'])
+            self.wake()
+
+    async def run(self):
+        """Dispatch jobs until cancelled. Jobs interrupted by a restart run again."""
+        self._wakeup = asyncio.Event()
+        requeued = self.store.requeue_running(self.worker)
+        if requeued:
+            logger.info(f"Requeued {requeued} jobs interrupted by the last shutdown")
+
+        while True:
+            self.store.heartbeat(self.worker)
+            stale = self.store.requeue_stale(self.worker_timeout)
+            if stale:
+                logger.warning(f"Requeued {stale} jobs from workers that stopped responding")
+
+            for job_id in list(self.active):
+                job = self.store.get(job_id)
+                if job and job['status'] == CANCELLED:
+                    self._stop(job_id)  # Cancelled through another process
+
+            started = False
+            while len(self.active) < self.max_concurrent:
+                job = self.store.claim_next(self.worker)
+                if job is None:
+                    break
+                self.active[job['id']] = asyncio.create_task(self._run_job(job))
+                started = True
+
+            if started and self.on_queue_changed:
+                try:
+                    await self.on_queue_changed(self.store.positions())
+                except Exception as e:
+                    logger.error(f"Error reporting queue positions: {e}")
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                # Aging can make a new job eligible, and old rows need purging
+                self.store.purge(older_than=24 * 3600)
+            self._wakeup.clear()
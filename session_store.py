@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from typing import Dict, Optional
+
+from metadata_cache import MetadataCache
+
+logger = logging.getLogger(__name__)
+
+
+class MemorySessionStore:
+    """In-process session store; sessions are lost on restart and not shared between processes"""
+
+    def __init__(self, ttl: float, max_entries: int = 10000):
+        self.ttl = ttl
+        self._cache = MetadataCache(max_entries, ttl)
+
+    def get(self, key: str) -> Optional[Dict]:
+        data = self._cache.get(key)
+        # Stored serialized, so callers can't mutate a session without saving it
+        return json.loads(data) if data is not None else None
+
+    def set(self, key: str, session: Dict):
+        self._cache.set(key, json.dumps(session))
+
+    def delete(self, key: str):
+        self._cache.invalidate(key)
+
+
+class SQLiteSessionStore:
+    """Session store in a SQLite file, shared by bot processes on the same host"""
+
+    def __init__(self, db_path: str, ttl: float):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.ttl = ttl
+        self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expires_at)")
+
+    def get(self, key: str) -> Optional[Dict]:
+        row = self._conn.execute(
+            "SELECT data FROM sessions WHERE key = ? AND expires_at >= ?", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, session: Dict):
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO sessions (key, data, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(session), now + self.ttl)
+        )
+        # Abandoned sessions are dropped as new ones come in
+        self._conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
+
+    def delete(self, key: str):
+        self._conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+
+class RedisSessionStore:
+    """Session store in Redis (or anything speaking its protocol), shared across hosts"""
+
+    def __init__(self, url: str, ttl: float, prefix: str = 'ytbot:session:'):
+        try:
+            import redis
+        except ImportError:
+            raise ValueError("SESSION_STORE points at Redis, but the redis package is not installed")
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> Optional[Dict]:
+        data = self._client.get(self.prefix + key)
+        return json.loads(data) if data is not None else None
+
+    def set(self, key: str, session: Dict):
+        self._client.set(self.prefix + key, json.dumps(session), ex=max(1, int(self.ttl)))
+
+    def delete(self, key: str):
+        self._client.delete(self.prefix + key)
+
+
+def create_session_store(backend: str, ttl: float, db_path: str = None):
+    """Build the session store named by SESSION_STORE: 'memory', 'sqlite' or a redis:// URL"""
+    if backend.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisSessionStore(backend, ttl)
+    if backend == 'sqlite':
+        return SQLiteSessionStore(db_path, ttl)
+    if backend != 'memory':
+        logger.warning(f"Unknown session store '{backend}', keeping sessions in memory")
+    return MemorySessionStore(ttl)
@@ -0,0 +1,58 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class CoalescedCallCancelled(RuntimeError):
+    """Raised to waiters when the call they joined was cancelled by its caller"""
+
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key into a single execution.
+
+    The first caller for a key runs the work; callers arriving while it is in
+    flight wait for the same result (or exception) instead of starting their own.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Run func once per key at a time and return (result, shared).
+
+        shared is True when the result came from a call started by someone else.
+        """
+        if key in self._calls:
+            return await self.wait(key), True
+
+        future = asyncio.get_running_loop().create_future()
+        # Nobody may be waiting, so don't let an unretrieved exception get logged
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._calls[key] = future
+
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.set_exception(CoalescedCallCancelled("Coalesced call was cancelled"))
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._calls[key]
+
+    async def wait(self, key: Hashable) -> Any:
+        """Wait for the in-flight call for key; returns None if there is none"""
+        future = self._calls.get(key)
+        if future is None:
+            return None
+        # Shielded so a waiter being cancelled doesn't cancel the shared call
+        return await asyncio.shield(future)
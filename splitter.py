@@ -0,0 +1,87 @@
+import os
+import json
+import logging
+import subprocess
+from typing import Callable, List, Optional
+
+from progress import DownloadCancelled
+
+logger = logging.getLogger(__name__)
+
+# Aim parts below the limit, since cuts can only fall on keyframes
+SIZE_HEADROOM = 0.9
+
+
+def probe_duration(file_path: str) -> float:
+    """Return the duration of a media file in seconds, as reported by ffprobe"""
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'json', file_path],
+        capture_output=True, text=True, check=True
+    )
+    return float(json.loads(result.stdout)['format']['duration'])
+
+
+def _part_paths(parts_dir: str) -> List[str]:
+    return sorted(os.path.join(parts_dir, name) for name in os.listdir(parts_dir))
+
+
+def _run_ffmpeg(args: List[str], should_stop: Optional[Callable[[], bool]] = None):
+    """Run ffmpeg to completion, or kill it as soon as should_stop() returns True"""
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    while True:
+        try:
+            _, stderr = process.communicate(timeout=0.5)
+            break
+        except subprocess.TimeoutExpired:
+            if should_stop and should_stop():
+                process.kill()
+                process.communicate()
+                raise DownloadCancelled("Split cancelled")
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args, stderr=stderr)
+
+
+def split_media(file_path: str, max_bytes: int, duration: Optional[float] = None, attempts: int = 3,
+                should_stop: Optional[Callable[[], bool]] = None) -> List[str]:
+    """Split a media file into parts of at most max_bytes and return them in order.
+
+    Streams are copied, never re-encoded, with ffmpeg's segment muxer, so each
+    part starts on a keyframe and plays on its own. The segment length comes
+    from the average bitrate; if a part still ends up too large (a long gap
+    between keyframes), the split is redone with shorter segments. Parts go
+    into a parts/ directory next to the file, which nothing else writes to,
+    and the original file is removed once they are written. should_stop is
+    polled while ffmpeg runs; it is killed as soon as that returns True.
+    """
+    size = os.path.getsize(file_path)
+    if size <= max_bytes:
+        return [file_path]
+
+    duration = duration or probe_duration(file_path)
+    parts_dir = os.path.join(os.path.dirname(file_path), 'parts')
+    os.makedirs(parts_dir, exist_ok=True)
+    ext = os.path.splitext(file_path)[1]
+    segment_time = duration * max_bytes / size * SIZE_HEADROOM
+
+    for _ in range(attempts):
+        for stale in _part_paths(parts_dir):
+            os.remove(stale)
+
+        _run_ffmpeg(
+            ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-i', file_path,
+             '-map', '0', '-c', 'copy', '-f', 'segment', '-segment_time', f"{segment_time:.3f}",
+             '-reset_timestamps', '1', os.path.join(parts_dir, f"part%03d{ext}")],
+            should_stop
+        )
+
+        parts = _part_paths(parts_dir)
+        largest = max(os.path.getsize(part) for part in parts)
+        if largest <= max_bytes:
+            os.remove(file_path)
+            logger.info(f"Split {os.path.basename(file_path)} into {len(parts)} parts")
+            return parts
+
+        segment_time *= max_bytes / largest * SIZE_HEADROOM
+
+    raise ValueError(f"Could not split {os.path.basename(file_path)} into parts below {max_bytes} bytes")
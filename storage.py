@@ -0,0 +1,225 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: other processes' directories are only protected by ACTIVE_WINDOW
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class StorageFullError(Exception):
+    """Raised when the download quota is used up by jobs that can't be evicted"""
+
+
+class StorageManager:
+    """Owns the per-job work directories under the download path.
+
+    Each job directory is registered with its owner while it is downloading
+    and marked ready once the file is waiting to be delivered. Either way it is
+    in use until remove() is called after delivery, and holds an exclusive lock
+    on its LOCK_FILE until then, so sweeps in other worker processes sharing the
+    download path leave it alone too. The lock goes away with the process, so
+    the directories of a crashed worker become evictable leftovers.
+
+    A background sweep evicts crash leftovers that are older than max_age, and
+    evicts the least recently used ones first whenever the quota is exceeded.
+    Directories in use are never touched, not even by a forced cleanup.
+    """
+
+    DOWNLOADING = 'downloading'
+    READY = 'ready'
+    LOCK_FILE = '.in-use'
+    # Untracked entries written to this recently belong to someone else's running download
+    ACTIVE_WINDOW = 120
+
+    def __init__(self, root: str, quota_bytes: int, max_age: float, gc_interval: float = 300):
+        self.root = os.path.abspath(root)
+        self.quota_bytes = quota_bytes
+        self.max_age = max_age
+        self.gc_interval = gc_interval
+        self._jobs: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._gc_lock = threading.Lock()  # One sweep at a time, so two never remove the same entry
+        # Bytes under the download path when it was last walked, for monitoring without another walk
+        self.measured_usage: Optional[int] = None
+        os.makedirs(self.root, exist_ok=True)
+
+    def create_job_dir(self, name: str, owner: Optional[int] = None) -> str:
+        """Create and register a fresh work directory for a download.
+
+        Walks the download path when a quota is set, so call it from an executor.
+        """
+        if self.quota_bytes > 0 and self.usage() >= self.quota_bytes:
+            self.collect_garbage()
+            if self.usage() >= self.quota_bytes:
+                raise StorageFullError("Download storage quota is exhausted")
+
+        job_dir = tempfile.mkdtemp(prefix=f"{name}-", dir=self.root)
+        lock = open(os.path.join(job_dir, self.LOCK_FILE), 'w')
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        lock.write('' if owner is None else str(owner))  # So the owner can clean it up if this process dies
+        lock.flush()
+        with self._lock:
+            self._jobs[job_dir] = {'owner': owner, 'state': self.DOWNLOADING, 'created_at': time.time(), 'lock': lock}
+        return job_dir
+
+    def mark_ready(self, job_dir: str):
+        """Mark a job's download as finished; its file now waits for delivery"""
+        with self._lock:
+            job = self._jobs.get(os.path.abspath(job_dir))
+            if job:
+                job['state'] = self.READY
+
+    def remove(self, path: str):
+        """Delete a job directory, or the job directory holding the given file"""
+        path = os.path.abspath(path)
+        job_dir = path if os.path.isdir(path) else os.path.dirname(path)
+
+        if os.path.dirname(job_dir) != self.root:
+            # Not one of ours (e.g. a file written directly into the root)
+            if os.path.isfile(path):
+                os.remove(path)
+            return
+
+        with self._lock:
+            job = self._jobs.pop(job_dir, None)
+        shutil.rmtree(job_dir, ignore_errors=True)
+        if job:
+            job['lock'].close()  # Releases the lock
+
+    def usage(self) -> int:
+        """Total bytes used under the download path"""
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+        self.measured_usage = total
+        return total
+
+    def _in_use_elsewhere(self, path: str) -> bool:
+        """Whether another process holds the lock of this job directory"""
+        if fcntl is None or not os.path.isdir(path):
+            return False
+        try:
+            with open(os.path.join(path, self.LOCK_FILE), 'r') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        except BlockingIOError:
+            return True
+        except OSError:
+            pass  # No lock file: a leftover from before locking, or not a job directory
+        return False
+
+    def _recorded_owner(self, path: str) -> Optional[str]:
+        try:
+            with open(os.path.join(path, self.LOCK_FILE), 'r') as lock:
+                return lock.read()
+        except OSError:
+            return None
+
+    def _entries(self) -> List[Tuple[str, Optional[Dict], float, int]]:
+        """List (path, job, last_modified, size) for everything directly under the root"""
+        entries = []
+        with self._lock:
+            jobs = dict(self._jobs)
+
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            last_modified, size = _tree_stats(path)
+            entries.append((path, jobs.get(path), last_modified, size))
+        return entries
+
+    def collect_garbage(self, force: bool = False, owner: Optional[int] = None) -> int:
+        """Evict stale jobs and crash leftovers; returns the number of entries removed.
+
+        Jobs of this process are in use until remove(), and those of other
+        processes until they release their directory lock; neither is evicted.
+        Untracked entries are leftovers from a crash (or .part files from an old
+        run) unless they were modified recently, which means another process is
+        still writing them. With force=True every evictable entry goes, not just
+        old ones. With owner set, only that user's leftovers are considered.
+        """
+        with self._gc_lock:
+            return self._collect_garbage(force, owner)
+
+    def _collect_garbage(self, force: bool, owner: Optional[int]) -> int:
+        now = time.time()
+        candidates = []
+        used = 0
+
+        for path, job, last_modified, size in self._entries():
+            used += size
+            if job is not None:
+                continue  # Downloading or being delivered here
+            if now - last_modified < self.ACTIVE_WINDOW or self._in_use_elsewhere(path):
+                continue  # Probably a download in another worker process
+            if owner is not None and self._recorded_owner(path) != str(owner):
+                continue
+            candidates.append((last_modified, path, size))
+
+        # Oldest first, so quota pressure evicts the least recently used entries
+        candidates.sort()
+        removed = 0
+        for last_modified, path, size in candidates:
+            expired = now - last_modified > self.max_age
+            over_quota = self.quota_bytes > 0 and used > self.quota_bytes
+            if not (force or expired or over_quota):
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+            used -= size
+            removed += 1
+
+        self.measured_usage = used
+        if removed:
+            logger.info(f"Storage cleanup removed {removed} entries, {used / (1024 * 1024):.1f} MB in use")
+        return removed
+
+    async def run(self):
+        """Run collect_garbage periodically until cancelled"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.collect_garbage)
+            except Exception as e:
+                logger.error(f"Error during storage cleanup: {e}")
+            await asyncio.sleep(self.gc_interval)
+
+
+def _tree_stats(path: str) -> Tuple[float, int]:
+    """Return (newest mtime, total size) for a file or directory tree"""
+    try:
+        if not os.path.isdir(path):
+            stat = os.stat(path)
+            return stat.st_mtime, stat.st_size
+
+        newest = os.stat(path).st_mtime
+        size = 0
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    stat = os.stat(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+                newest = max(newest, stat.st_mtime)
+                size += stat.st_size
+        return newest, size
+    except OSError:
+        return time.time(), 0
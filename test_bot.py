@@ -9,6 +9,14 @@ import os
 import sys
 from youtube_downloader import YouTubeDownloader
 from config import AUDIO_QUALITY_PRESETS
+from metadata_cache import MetadataCache, canonical_key, video_key
+from scheduler import dispatch_order
+from format_index import build_format_index, available_qualities, select_format
+from metrics import MetricsRegistry
+from tracing import JsonFormatter, TraceFilter, JobProfiler, set_trace, reset_trace
+from ydl_pool import YoutubeDLPool
+from storage import StorageManager, StorageFullError
+import splitter
 
 async def test_video_info():
     """Test getting video information"""
@@ -69,6 +77,367 @@ async def test_available_qualities():
     except Exception as e:
         print(f"❌ Error getting qualities: {e}")
 
+def test_metadata_cache():
+    """Test metadata cache keys, LRU eviction and TTL expiry"""
+    print("\n🧪 Testing metadata cache...")
+    
+    assert canonical_key("https://youtu.be/dQw4w9WgXcQ") == canonical_key("https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=5")
+    assert canonical_key("https://www.youtube.com/watch?v=abc&list=PL123") == "playlist:PL123"
+    
+    cache = MetadataCache(max_entries=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)  # Evicts "b", the least recently used entry
+    assert cache.get("b") is None and cache.get("a") == 1
+    
+    cache.set("d", 4, ttl=-1)  # Already expired
+    assert cache.get("d") is None
+    
+    print(f"✅ Metadata cache works: {cache.stats()}")
+
+async def test_cache_counting():
+    """Test that each request counts as one cache hit or miss, and checks count as neither"""
+    print("\n🧪 Testing cache hit counting...")
+    
+    import tempfile
+    from file_id_cache import FileIdCache
+    file_ids = FileIdCache(os.path.join(tempfile.mkdtemp(), 'file_ids.db'))
+    file_ids.set('abc', 'video', '720p', 'file-1', 'video')
+    assert file_ids.peek('abc', 'video', '720p') == ('file-1', 'video')
+    assert file_ids.get('abc', 'video', '720p') == ('file-1', 'video')
+    assert (file_ids.hits, file_ids.misses) == (1, 0)
+    
+    downloader = YouTubeDownloader()
+    downloader.metadata_cache.set(video_key('abc'), {'id': 'abc', 'formats': []})
+    assert (await downloader.resolve_entry({'id': 'abc', 'url': 'https://www.youtube.com/watch?v=abc'}))['id'] == 'abc'
+    assert (downloader.metadata_cache.hits, downloader.metadata_cache.misses) == (1, 0)
+    
+    print("✅ Cache hit counting works")
+
+async def test_cancel_queued_download():
+    """Test that a download cancelled while waiting for a worker gives up its place at once"""
+    print("\n🧪 Testing cancelling a queued download...")
+    
+    import time
+    from worker_pool import WorkerPool
+    downloader = YouTubeDownloader()
+    downloader.download_pool = WorkerPool('download', 1, 5)
+    stopped = []
+    
+    running = asyncio.ensure_future(downloader._run_download(None, time.sleep, 0.5))
+    await asyncio.sleep(0.05)
+    queued = asyncio.ensure_future(downloader._run_download(lambda: stopped.append(True), time.sleep, 0))
+    await asyncio.sleep(0.05)
+    assert downloader.download_pool.queued == 1
+    
+    start = time.monotonic()
+    queued.cancel()
+    await asyncio.gather(queued, return_exceptions=True)
+    assert time.monotonic() - start < 0.2 and not stopped
+    assert downloader.download_pool.queued == 0
+    await running
+    downloader.download_pool.shutdown()
+    
+    print("✅ Cancelling a queued download works")
+
+def test_dispatch_order():
+    """Test that the job queue takes turns between users and favours cheap jobs"""
+    print("\n🧪 Testing job dispatch order...")
+    
+    def job(job_id, user_id, priority, created_at):
+        return {'id': job_id, 'user_id': user_id, 'priority': priority, 'created_at': created_at}
+    
+    pending = [job(1, 1, 3, 0), job(2, 1, 3, 1), job(3, 2, 0, 2), job(4, 3, 3, 3)]
+    order = dispatch_order(pending, {}, {}, max_per_user=1, aging_seconds=120, now=10)
+    # Audio first, then one 4K job per user; user 1's second job waits for a free slot
+    assert [j['id'] for j in order] == [3, 1, 4]
+    
+    # A heavy job that waited long enough overtakes a fresh cheap one
+    order = dispatch_order([job(1, 1, 3, 0), job(2, 2, 0, 1000)], {}, {}, 1, 120, now=1000)
+    assert order[0]['id'] == 1
+    
+    print("✅ Job dispatch order is fair")
+
+def test_format_index():
+    """Test that the format index offers real qualities and picks exact formats"""
+    print("\n🧪 Testing format index...")
+    
+    info = {'id': 'abc', 'duration': 100, 'formats': [
+        {'format_id': '140', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a.40.2', 'abr': 128},
+        {'format_id': '18', 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'mp4a.40.2', 'height': 360, 'width': 640, 'tbr': 500},
+        {'format_id': '136', 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'none', 'height': 720, 'width': 1280, 'tbr': 1500},
+    ]}
+    index = build_format_index(info)
+    
+    assert available_qualities(index, 'video') == ['720p', '480p', '360p']
+    assert select_format(index, 'video', '1080p')['format_id'] == '136+140'
+    assert select_format(index, 'video', '480p')['format_id'] == '18'
+    assert select_format(index, 'audio', 'best')['filesize'] == 1600000
+    
+    print("✅ Format index works")
+
+def test_queue_position_reports():
+    """Test that processes sharing the queue report each new queue position only once"""
+    print("\n🧪 Testing queue position reports...")
+    
+    import tempfile
+    from scheduler import JobStore
+    db_path = os.path.join(tempfile.mkdtemp(), 'jobs.sqlite3')
+    bot_store, worker_store = JobStore(db_path), JobStore(db_path)
+    job_id = bot_store.enqueue(1, 1, 1, 'https://www.youtube.com/watch?v=abc', 'audio', 'best')
+    
+    assert bot_store.record_position(job_id, 2)
+    assert not worker_store.record_position(job_id, 2)  # Already shown by the bot
+    assert worker_store.record_position(job_id, 1)
+    
+    worker_store.claim_next('worker')
+    worker_store.requeue_running('worker')
+    assert bot_store.record_position(job_id, 1)  # Its message showed the download meanwhile
+    
+    print("✅ Queue position reports work")
+
+def test_metrics():
+    """Test that metrics render in the Prometheus text format"""
+    print("\n🧪 Testing metrics...")
+    
+    registry = MetricsRegistry()
+    failures = registry.counter('test_failures_total', 'Failures', ['reason'])
+    stages = registry.histogram('test_stage_seconds', 'Stages', ['stage'], buckets=(1, 10))
+    depth = registry.gauge('test_queue_depth', 'Queue depth')
+    disk = registry.gauge('test_disk_bytes', 'Disk use')
+    
+    failures.inc(reason='busy')
+    failures.inc(reason='busy')
+    stages.observe(0.5, stage='upload')
+    stages.observe(5, stage='upload')
+    depth.set_function(lambda: 3)
+    disk.set_function(lambda: None)  # Not measured yet
+    text = registry.render()
+    
+    assert 'test_failures_total{reason="busy"} 2' in text
+    assert 'test_stage_seconds_bucket{stage="upload",le="1"} 1' in text
+    assert 'test_stage_seconds_bucket{stage="upload",le="+Inf"} 2' in text
+    assert 'test_stage_seconds_sum{stage="upload"} 5.5' in text
+    assert 'test_queue_depth 3' in text
+    assert not any(line.startswith('test_disk_bytes ') for line in text.splitlines())
+    
+    print("✅ Metrics work")
+
+def test_tracing():
+    """Test that JSON log lines carry the trace and job IDs"""
+    print("\n🧪 Testing log tracing...")
+    
+    import json
+    import logging
+    record = logging.LogRecord('bot', logging.INFO, __file__, 1, "download took %.1fs", (1.5,), None)
+    record.stage = 'download'
+    
+    tokens = set_trace('42:7', job_id=3)
+    try:
+        TraceFilter().filter(record)
+    finally:
+        reset_trace(tokens)
+    entry = json.loads(JsonFormatter().format(record))
+    
+    assert entry['message'] == "download took 1.5s"
+    assert entry['trace_id'] == '42:7' and entry['job_id'] == 3
+    assert entry['stage'] == 'download'
+    assert record.context == "[job=3 trace=42:7] "
+    
+    print("✅ Log tracing works")
+
+def test_job_profiler():
+    """Test that a call overlapping a profiled one runs unprofiled instead of failing"""
+    print("\n🧪 Testing job profiling...")
+    
+    import tempfile
+    import threading
+    path = tempfile.mkdtemp()
+    first, second = JobProfiler(1, path), JobProfiler(2, path)
+    results = []
+    
+    def overlapping():
+        thread = threading.Thread(target=lambda: results.append(second.wrap(lambda: 'second')()))
+        thread.start()
+        thread.join()
+        return 'first'
+    
+    results.append(first.wrap(overlapping)())
+    second.stop()
+    first.stop()
+    
+    assert results == ['second', 'first']
+    assert os.path.exists(os.path.join(path, 'job-1.prof'))
+    
+    print("✅ Job profiling works")
+
+def test_ydl_pool():
+    """Test that YoutubeDL instances are reused across calls with different per-call options"""
+    print("\n🧪 Testing YoutubeDL pool...")
+    
+    import yt_dlp
+    pool = YoutubeDLPool(2, lambda: yt_dlp.YoutubeDL)
+    options = {'quiet': True, 'no_warnings': True}
+    
+    with pool.borrow(dict(options, format='18', outtmpl='one/%(id)s.%(ext)s')) as ydl:
+        first = ydl
+    with pool.borrow(dict(options, format='22', outtmpl='two/%(id)s.%(ext)s')) as ydl:
+        assert ydl is first
+        assert ydl.params['outtmpl']['default'] == 'two/%(id)s.%(ext)s'
+        assert ydl.params['format'] == '22'
+    with pool.borrow(dict(options, extract_flat='in_playlist')) as ydl:
+        assert ydl is not first  # Different shared options
+    try:
+        with pool.borrow(options) as ydl:
+            raise RuntimeError("download failed")
+    except RuntimeError:
+        pass
+    with pool.borrow(options) as ydl:
+        assert ydl is not first  # Not reused after a failure
+    pool.close()
+    
+    print(f"✅ YoutubeDL pool works: {pool.created} created, {pool.reused} reused")
+
+def test_storage():
+    """Test that jobs stay put until removed, whatever the quota or a forced cleanup wants"""
+    print("\n🧪 Testing storage eviction...")
+    
+    import tempfile
+    import time
+    root = tempfile.mkdtemp()
+    storage = StorageManager(root, quota_bytes=1000, max_age=60)
+    
+    job = storage.create_job_dir('a', owner=1)
+    with open(os.path.join(job, 'a.mp4'), 'wb') as f:
+        f.write(b'x' * 1500)
+    storage.mark_ready(job)  # Being uploaded
+    try:
+        storage.create_job_dir('b', owner=2)
+        assert False, "quota not enforced"
+    except StorageFullError:
+        pass
+    assert storage.collect_garbage(force=True) == 0
+    assert os.path.exists(os.path.join(job, 'a.mp4'))
+    
+    leftover = os.path.join(root, 'crashed-job')
+    os.mkdir(leftover)
+    with open(os.path.join(leftover, 'c.mp4.part'), 'wb') as f:
+        f.write(b'x' * 100)
+    old = time.time() - 2 * StorageManager.ACTIVE_WINDOW
+    os.utime(os.path.join(leftover, 'c.mp4.part'), (old, old))
+    os.utime(leftover, (old, old))
+    assert storage.collect_garbage() == 1
+    assert not os.path.exists(leftover) and os.path.exists(job)
+    assert storage.measured_usage == storage.usage()
+    
+    # Another worker process sharing the download path: job is in use, however old it looks
+    os.utime(job, (old, old))
+    os.utime(os.path.join(job, 'a.mp4'), (old, old))
+    other_worker = StorageManager(root, quota_bytes=1000, max_age=60)
+    assert other_worker.collect_garbage(force=True) == 0
+    assert os.path.exists(os.path.join(job, 'a.mp4'))
+    
+    storage.remove(os.path.join(job, 'a.mp4'))
+    assert not os.path.exists(job)
+    storage.remove(storage.create_job_dir('b', owner=2))
+    assert os.listdir(root) == []
+    
+    print("✅ Storage keeps jobs until they are removed")
+
+def test_split_media():
+    """Test that splitting retries with shorter segments and leaves files named like parts alone"""
+    print("\n🧪 Testing media splitting...")
+    
+    import tempfile
+    directory = tempfile.mkdtemp()
+    file_path = os.path.join(directory, 'party mix.mp4')
+    with open(file_path, 'wb') as f:
+        f.write(b'x' * 1000)
+    segment_times = []
+    
+    def fake_ffmpeg(args, should_stop=None):
+        # 10 bytes a second, except that the first cut falls 10 s late (a long gap between keyframes)
+        assert os.path.exists(file_path)
+        segment_time = float(args[args.index('-segment_time') + 1])
+        segment_times.append(segment_time)
+        sizes, remaining = [], 1000
+        while remaining > 0:
+            size = min(remaining, int(segment_time * 10) + (100 if not sizes else 0))
+            sizes.append(size)
+            remaining -= size
+        for number, size in enumerate(sizes):
+            with open(args[-1] % number, 'wb') as f:
+                f.write(b'x' * size)
+    
+    run_ffmpeg = splitter._run_ffmpeg
+    splitter._run_ffmpeg = fake_ffmpeg
+    try:
+        parts = splitter.split_media(file_path, 400, duration=100)
+    finally:
+        splitter._run_ffmpeg = run_ffmpeg
+    
+    assert len(segment_times) == 2 and segment_times[1] < segment_times[0]
+    assert all(os.path.getsize(part) <= 400 for part in parts)
+    assert sum(os.path.getsize(part) for part in parts) == 1000
+    assert not os.path.exists(file_path)
+    
+    print(f"✅ Media splitting works: {len(parts)} parts after {len(segment_times)} attempts")
+
+def test_cancel_flag():
+    """Test that a cancel flag survives pickling for a process pool and stops yt-dlp hooks"""
+    print("\n🧪 Testing cancel flag...")
+    
+    import pickle
+    import tempfile
+    from progress import CancelFlag, DownloadCancelled
+    flag = CancelFlag(os.path.join(tempfile.mkdtemp(), '.cancelled'))
+    copied = pickle.loads(pickle.dumps(flag))  # As it reaches a worker process
+    copied.hook({'status': 'downloading'})
+    
+    flag.set()
+    assert copied.is_set()
+    try:
+        copied.hook({'status': 'downloading'})
+        assert False, "download not stopped"
+    except DownloadCancelled:
+        pass
+    
+    print("✅ Cancel flag works")
+
+def test_stoppable_ffmpeg():
+    """Test that the subprocess yt-dlp's ffmpeg post-processors wait for is killed on cancel"""
+    print("\n🧪 Testing cancelling post-processing...")
+    
+    import subprocess
+    import threading
+    import time
+    import youtube_downloader
+    from progress import DownloadCancelled
+    youtube_downloader._load_yt_dlp()
+    from yt_dlp.postprocessor import ffmpeg
+    
+    cancelled = threading.Event()
+    threading.Timer(0.3, cancelled.set).start()
+    token = youtube_downloader._ffmpeg_should_stop.set(cancelled.is_set)
+    start = time.monotonic()
+    try:
+        # What FFmpegPostProcessor.real_run_ffmpeg calls, with a long ffmpeg pass standing in
+        ffmpeg.Popen.run([sys.executable, '-c', 'import time; time.sleep(30)'], text=True,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
+        assert False, "post-processing not stopped"
+    except DownloadCancelled:
+        pass
+    finally:
+        youtube_downloader._ffmpeg_should_stop.reset(token)
+    assert time.monotonic() - start < 5
+    
+    stdout, _, returncode = ffmpeg.Popen.run([sys.executable, '-c', 'print("done")'], text=True,
+                                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert stdout.strip() == 'done' and returncode == 0  # Unchanged outside a job
+    
+    print("✅ Cancelling post-processing works")
+
 def test_config():
     """Test configuration loading"""
     print("\n🧪 Testing configuration...")
@@ -100,6 +469,22 @@ async def main():
     # Test quality presets
     await test_quality_presets()
     
+    # Test metadata cache (offline)
+    test_metadata_cache()
+    await test_cache_counting()
+    await test_cancel_queued_download()
+    test_dispatch_order()
+    test_format_index()
+    test_queue_position_reports()
+    test_metrics()
+    test_tracing()
+    test_job_profiler()
+    test_ydl_pool()
+    test_storage()
+    test_split_media()
+    test_cancel_flag()
+    test_stoppable_ffmpeg()
+    
     # Test video info (requires internet connection)
     await test_video_info()
     
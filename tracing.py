@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import cProfile
+import logging
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Callable, Optional, Tuple
+
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Which conversation and job the running code works for. Tasks inherit these when
+# they are created and WorkerPool copies them into its threads, so every log line of
+# a job carries its IDs from the first message to the last upload.
+_trace_id: ContextVar[Optional[str]] = ContextVar('trace_id', default=None)
+_job_id: ContextVar[Optional[int]] = ContextVar('job_id', default=None)
+_profiler: ContextVar[Optional['JobProfiler']] = ContextVar('profiler', default=None)
+
+# Attributes every LogRecord has; anything else was passed with extra= and becomes a JSON field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'context'}
+
+
+def message_trace_id(chat_id: int, message_id: int) -> str:
+    """Trace ID of a URL's status message, which the buttons and later the job's updates reuse"""
+    return f"{chat_id}:{message_id}"
+
+
+def set_trace(trace_id: Optional[str], job_id: Optional[int] = None) -> Tuple:
+    """Tag what runs from here on in this task; undo with reset_trace(tokens)"""
+    return _trace_id.set(trace_id), _job_id.set(job_id)
+
+
+def reset_trace(tokens: Tuple):
+    trace_token, job_token = tokens
+    _job_id.reset(job_token)
+    _trace_id.reset(trace_token)
+
+
+def current_trace() -> Tuple[Optional[str], Optional[int]]:
+    return _trace_id.get(), _job_id.get()
+
+
+def record_stage(stage: str, seconds: float):
+    """Count a finished stage in the metrics and log it as part of the job's trace"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    logger.info(f"{stage} took {seconds:.2f}s", extra={'stage': stage, 'seconds': round(seconds, 3)})
+
+
+@contextmanager
+def timed_stage(stage: str):
+    """record_stage() for the with block"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.monotonic() - start)
+
+
+class TraceFilter(logging.Filter):
+    """Add the current trace and job IDs to every record passing through a handler"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id, record.job_id = current_trace()
+        parts = []
+        if record.job_id is not None:
+            parts.append(f"job={record.job_id}")
+        if record.trace_id is not None:
+            parts.append(f"trace={record.trace_id}")
+        record.context = f"[{' '.join(parts)}] " if parts else ''
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with extra= fields (e.g. stage timings) as keys of their own"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def configure_logging(log_format: str = 'text', level: str = 'INFO'):
+    """Set up the root logger once for the whole process: 'text' for people, 'json' for log collectors"""
+    handler = logging.StreamHandler()
+    handler.addFilter(TraceFilter())
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(context)s%(message)s'))
+    logging.basicConfig(handlers=[handler], level=level, force=True)
+
+
+class JobProfiler:
+    """cProfile and tracemalloc data for one job, written to a directory when it ends.
+
+    Only blocking work that WorkerPool runs in threads for the job is profiled
+    (yt-dlp extraction and downloads, ffmpeg splitting): that is where jobs spend
+    their CPU, and the event loop interleaves all jobs so it can't be split up per
+    job. tracemalloc is process-wide, so with several jobs running at once the
+    snapshot includes their allocations too. Only one profiler can be active in a
+    process (enforced since Python 3.12), so calls that overlap one already being
+    profiled, here or by another tool, run unprofiled rather than fail.
+    """
+
+    _lock = threading.Lock()
+    _profiling = threading.Lock()  # Held while a call is profiled
+    _tracing_jobs = 0  # Profiled jobs running, so tracemalloc stops with the last one
+    _started_tracemalloc = False  # Left alone if it was already on, e.g. through PYTHONTRACEMALLOC
+
+    def __init__(self, job_id: int, path: str):
+        self.job_id = job_id
+        self.path = path
+        self._stats: Optional[pstats.Stats] = None
+        self._stats_lock = threading.Lock()
+        with JobProfiler._lock:
+            if JobProfiler._tracing_jobs == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                JobProfiler._started_tracemalloc = True
+            JobProfiler._tracing_jobs += 1
+        self._token = _profiler.set(self)
+        self._started = time.monotonic()
+
+    def _add(self, profile: cProfile.Profile):
+        with self._stats_lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+
+    def wrap(self, call: Callable) -> Callable:
+        """Profile call in whichever thread runs it, adding the result to this job"""
+        def profiled():
+            if not JobProfiler._profiling.acquire(blocking=False):
+                logger.info("Not profiling a call: another one is being profiled")
+                return call()
+            try:
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError as e:
+                    logger.info(f"Not profiling a call: {e}")
+                    return call()
+                try:
+                    return call()
+                finally:
+                    profile.disable()
+                    self._add(profile)
+            finally:
+                JobProfiler._profiling.release()
+        return profiled
+
+    def stop(self):
+        """Write job-<id>.prof (load with pstats) and job-<id>.tracemalloc (tracemalloc.Snapshot.load)"""
+        _profiler.reset(self._token)
+        snapshot = None
+        if tracemalloc.is_tracing():
+            # Leave out what the profiling itself allocated
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, module.__file__) for module in (cProfile, pstats, tracemalloc)
+            ])
+        with JobProfiler._lock:
+            JobProfiler._tracing_jobs -= 1
+            if JobProfiler._tracing_jobs == 0 and JobProfiler._started_tracemalloc:
+                tracemalloc.stop()
+                JobProfiler._started_tracemalloc = False
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            base = os.path.join(self.path, f"job-{self.job_id}")
+            if self._stats is not None:
+                self._stats.dump_stats(f"{base}.prof")
+            if snapshot is not None:
+                snapshot.dump(f"{base}.tracemalloc")
+            logger.info(f"Wrote profile to {base}.*", extra={'profile': base,
+                                                             'seconds': round(time.monotonic() - self._started, 3)})
+        except OSError as e:
+            logger.error(f"Could not write profile of job {self.job_id}: {e}")
+
+
+def profiled(call: Callable) -> Callable:
+    """call, profiled for the current job if it has a JobProfiler"""
+    profiler = _profiler.get()
+    return profiler.wrap(call) if profiler else call
@@ -0,0 +1,32 @@
+import os
+import signal
+import asyncio
+import logging
+from bot import YouTubeBot
+from config import INSTANCE_NAME
+
+logger = logging.getLogger(__name__)
+
+
+async def run():
+    """Run one download worker until it is interrupted or terminated."""
+    # Unique per process, so several workers can run on one host
+    worker = YouTubeBot(runs_jobs=True, worker_name=f"worker-{INSTANCE_NAME}-{os.getpid()}")
+    task = asyncio.create_task(worker.run_worker())
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        await task
+    except asyncio.CancelledError:
+        logger.info("Download worker stopped")
+
+
+def main():
+    """Main function to run a download worker."""
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import time
+import asyncio
+import functools
+import contextvars
+import logging
+from contextlib import asynccontextmanager
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Optional
+
+from metrics import POOL_WAIT_SECONDS
+from tracing import profiled
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPoolFullError(Exception):
+    """Raised when a worker pool already has its maximum number of waiting calls"""
+
+
+class WorkerPool:
+    """Bounded executor for blocking yt-dlp work.
+
+    At most ``max_workers`` calls run at the same time and up to ``queue_size``
+    more may wait for a free slot. Anything beyond that is rejected with
+    WorkerPoolFullError so the backlog can never grow without bound.
+    """
+
+    def __init__(self, name: str, max_workers: int, queue_size: int, kind: str = 'thread'):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.queue_size = max(0, queue_size)
+        self.kind = kind
+        self.active = 0
+        self._pending = 0
+        self._slots: Optional[asyncio.Semaphore] = None
+
+        if kind == 'process':
+            self._executor: Executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        elif kind == 'thread':
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+        else:
+            raise ValueError(f"Unknown worker pool kind: {kind}")
+
+    @property
+    def queued(self) -> int:
+        """Number of calls waiting for a free worker"""
+        return self._pending - self.active
+
+    async def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run a blocking callable in the pool and await its result"""
+        async with self.slot():
+            return await self.submit(func, *args, **kwargs)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold one of the workers for the with block, waiting for a free one first.
+
+        For callers that treat waiting and running differently, e.g. to give up
+        while queued but see a started call through: submit() the call inside.
+        """
+        if self._pending >= self.max_workers + self.queue_size:
+            raise WorkerPoolFullError(f"{self.name} pool is full ({self._pending} calls in flight)")
+
+        # Created lazily so the semaphore belongs to the running event loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+
+        self._pending += 1
+        queued_at = time.monotonic()
+        try:
+            async with self._slots:
+                POOL_WAIT_SECONDS.observe(time.monotonic() - queued_at, pool=self.name)
+                self.active += 1
+                try:
+                    yield
+                finally:
+                    self.active -= 1
+        finally:
+            self._pending -= 1
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> asyncio.Future:
+        """Start a blocking callable in the executor; only while holding a slot()"""
+        call = functools.partial(func, *args, **kwargs)
+        if self.kind == 'thread':
+            # Keep the job's trace IDs (and profiler) in the worker thread
+            call = functools.partial(contextvars.copy_context().run, profiled(call))
+        return asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting work and release the underlying executor"""
+        self._executor.shutdown(wait=wait)
+        logger.info(f"{self.name} worker pool shut down")
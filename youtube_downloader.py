@@ -1,43 +1,237 @@
 import os
+import copy
+import time
 import asyncio
-import yt_dlp
-from typing import Dict, List, Optional, Tuple
+import functools
+import threading
+import subprocess
+from contextvars import ContextVar
+from collections import deque
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple, Union
 import logging
-from config import DOWNLOAD_PATH, AUDIO_QUALITY_PRESETS, VIDEO_QUALITY_PRESETS, VIDEO_QUALITY_ALTERNATIVES, MAX_PLAYLIST_ITEMS
+from config import (
+    DOWNLOAD_PATH, AUDIO_QUALITY_PRESETS, VIDEO_QUALITY_PRESETS, VIDEO_QUALITY_ALTERNATIVES, MAX_PLAYLIST_ITEMS,
+    PLAYLIST_PAGE_SIZE, PLAYLIST_CONCURRENCY,
+    DOWNLOAD_EXECUTOR, EXTRACT_WORKERS, DOWNLOAD_WORKERS, WORKER_QUEUE_SIZE, YDL_POOL_SIZE,
+    METADATA_CACHE_SIZE, METADATA_CACHE_TTL, DOWNLOAD_QUOTA_MB, DOWNLOAD_MAX_AGE, STORAGE_GC_INTERVAL,
+    AUDIO_OUTPUT_FORMAT, AUDIO_MP3_BITRATE, TELEGRAM_UPLOAD_LIMIT_MB, SPLIT_OVERSIZED
+)
+from format_index import build_format_index, available_qualities, select_format_within
+from metadata_cache import MetadataCache, canonical_key, video_key
+from metrics import BYTES
+from progress import CancelFlag, DownloadCancelled, DownloadProgress
+from splitter import split_media
+from storage import StorageManager, StorageFullError
+from tracing import record_stage
+from worker_pool import WorkerPool, WorkerPoolFullError
+from ydl_pool import YoutubeDLPool
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Set in a job directory to stop work running in a process pool (see CancelFlag)
+CANCEL_FILE = '.cancelled'
+
+# Source audio codec that can be copied into each output format without re-encoding
+AUDIO_SOURCE_CODECS = {
+    'mp3': None,
+    'm4a': 'aac',
+    'opus': 'opus',
+    'native': 'aac',  # No ffmpeg at all; m4a/AAC plays inline in Telegram
+}
+
+
+class FileTooLargeError(Exception):
+    """Raised when even the smallest format would exceed the upload limit and splitting is off"""
+
+
+# The helpers below block on network and ffmpeg, so they only ever run inside a
+# WorkerPool. They live at module level to stay picklable for process pools.
+
+def _timed(func: Callable, *args, **kwargs) -> Tuple:
+    """Call func and return (result, seconds it took), timed inside the worker"""
+    start = time.monotonic()
+    result = func(*args, **kwargs)
+    return result, time.monotonic() - start
+
+
+# Polled while yt-dlp's post-processors wait for ffmpeg in this context (see _make_ffmpeg_stoppable)
+_ffmpeg_should_stop: ContextVar[Optional[Callable[[], bool]]] = ContextVar('ffmpeg_should_stop', default=None)
+
+
+def _load_yt_dlp():
+    """Import yt-dlp where it runs. It is the slowest import by far (its extractor
+    registry), so the bot starts without it and loads it on first use or preload()."""
+    import yt_dlp
+    _make_ffmpeg_stoppable()
+    return yt_dlp
+
+
+def _make_ffmpeg_stoppable():
+    """Let a cancelled job kill the ffmpeg its post-processors are running.
+
+    yt-dlp runs ffmpeg (mp3 transcodes, merges, remuxes) through Popen.run(),
+    which waits for it without a timeout, so the hooks can only stop a job
+    between post-processors. For a long video that one ffmpeg pass can take
+    most of the job. The Popen used there is replaced with one that waits in
+    short steps while _ffmpeg_should_stop is set, and kills ffmpeg (Popen.run
+    does that on any exception) once it returns True.
+    """
+    from yt_dlp.postprocessor import ffmpeg
+    if getattr(ffmpeg.Popen, 'stoppable', False):
+        return
+
+    class StoppablePopen(ffmpeg.Popen):
+        stoppable = True
+
+        def communicate(self, input=None, timeout=None):
+            should_stop = _ffmpeg_should_stop.get()
+            if should_stop is None or timeout is not None:
+                return super().communicate(input, timeout)
+            while True:
+                try:
+                    return super().communicate(input, timeout=0.5)
+                except subprocess.TimeoutExpired:
+                    input = None  # Already sent; communicate() refuses it a second time
+                    if should_stop():
+                        raise DownloadCancelled("Post-processing cancelled")
+
+    ffmpeg.Popen = StoppablePopen
+
+
+def _preload():
+    _load_yt_dlp()
+
+
+# YoutubeDL instances of this process (each worker process of a process pool has its own)
+_ydl_pool = YoutubeDLPool(YDL_POOL_SIZE, lambda: _load_yt_dlp().YoutubeDL)
+
+
+def _extract_info(url: str, ydl_opts: Dict) -> Optional[Dict]:
+    """Extract metadata with yt-dlp and return a plain, picklable info dict"""
+    with _ydl_pool.borrow(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+        return ydl.sanitize_info(info) if info else None
+
+
+def _download_info(info: Dict, ydl_opts: Dict,
+                   progress: Optional[Union[DownloadProgress, CancelFlag]] = None) -> Tuple[Optional[str], Dict[str, float]]:
+    """Download from an already extracted info dict and return (final file path, stage timings).
+
+    The path is reported by yt-dlp's own hooks: the last post-processor
+    (MoveFiles) announces where the finished file ended up. The same hooks
+    time the post-processors, so the timings split the work into 'download'
+    and 'postprocess' seconds. progress, if given, is fed by them too, and
+    stops the download once cancelled, killing ffmpeg if it is running.
+    """
+    final_paths = []
+    postprocessing = {'seconds': 0.0, 'started': None}
+    
+    def record_path(d):
+        if d.get('status') == 'finished':
+            path = d.get('info_dict', {}).get('filepath') or d.get('filename')
+            if path:
+                final_paths.append(path)
+    
+    def time_postprocessor(d):
+        if d.get('status') == 'started':
+            postprocessing['started'] = time.monotonic()
+        elif d.get('status') == 'finished' and postprocessing['started'] is not None:
+            postprocessing['seconds'] += time.monotonic() - postprocessing['started']
+            postprocessing['started'] = None
+    
+    progress_hooks, postprocessor_hooks = [record_path], [record_path, time_postprocessor]
+    if progress is not None:
+        progress_hooks.append(progress.hook)
+        postprocessor_hooks.append(progress.postprocessor_hook)
+    
+    start = time.monotonic()
+    ydl_opts = dict(ydl_opts, progress_hooks=progress_hooks, postprocessor_hooks=postprocessor_hooks)
+    token = _ffmpeg_should_stop.set((lambda: progress.cancelled) if progress is not None else None)
+    try:
+        with _ydl_pool.borrow(ydl_opts) as ydl:
+            ydl.process_ie_result(info, download=True)
+    finally:
+        _ffmpeg_should_stop.reset(token)
+    
+    timings = {
+        'download': time.monotonic() - start - postprocessing['seconds'],
+        'postprocess': postprocessing['seconds'],
+    }
+    return (final_paths[-1] if final_paths else None), timings
+
+
 class YouTubeDownloader:
     def __init__(self):
         self.download_path = DOWNLOAD_PATH
         os.makedirs(self.download_path, exist_ok=True)
+        # Separate pools so quick metadata lookups never wait behind long downloads
+        self.extract_pool = WorkerPool('extract', EXTRACT_WORKERS, WORKER_QUEUE_SIZE, DOWNLOAD_EXECUTOR)
+        self.download_pool = WorkerPool('download', DOWNLOAD_WORKERS, WORKER_QUEUE_SIZE, DOWNLOAD_EXECUTOR)
+        self.metadata_cache = MetadataCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+        self.storage = StorageManager(self.download_path, DOWNLOAD_QUOTA_MB * 1024 * 1024, DOWNLOAD_MAX_AGE, STORAGE_GC_INTERVAL)
+        self.upload_limit = TELEGRAM_UPLOAD_LIMIT_MB * 1024 * 1024
         
-    def _get_ydl_opts(self, download_type: str = 'audio', quality: str = 'best', output_template: str = '%(title)s.%(ext)s') -> Dict:
-        """Get yt-dlp options for audio or video download"""
+    def _get_ydl_opts(self, download_type: str = 'audio', quality: str = 'best', output_template: str = '%(title)s.%(ext)s',
+                      output_dir: str = None, format_id: str = None) -> Dict:
+        """Get yt-dlp options for audio or video download.
+
+        Streams are copied into their container whenever the codecs allow it;
+        ffmpeg only re-encodes when the requested output really needs it.
+        format_id, when given, is tried before the quality preset.
+        """
+        output_dir = output_dir or self.download_path
         if download_type == 'audio':
             quality_format = AUDIO_QUALITY_PRESETS.get(quality, AUDIO_QUALITY_PRESETS['best'])
-            return {
+            if format_id:
+                quality_format = f"{format_id}/{quality_format}"
+            ydl_opts = {
                 'format': quality_format,
-                'outtmpl': os.path.join(self.download_path, output_template),
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
+                'outtmpl': os.path.join(output_dir, output_template),
                 'writesubtitles': False,
                 'writeautomaticsub': False,
                 'ignoreerrors': True,
                 'no_warnings': True,
                 'quiet': True,
             }
+            
+            output_format = AUDIO_OUTPUT_FORMAT if AUDIO_OUTPUT_FORMAT in AUDIO_SOURCE_CODECS else 'mp3'
+            if AUDIO_SOURCE_CODECS[output_format]:
+                # Prefer sources that can be stream-copied into the output container
+                ydl_opts['format_sort'] = [f"acodec:{AUDIO_SOURCE_CODECS[output_format]}"]
+            
+            if output_format == 'mp3':
+                # YouTube never serves mp3, so this always transcodes
+                ydl_opts['postprocessors'] = [{
+                    'key': 'FFmpegExtractAudio',
+                    'preferredcodec': 'mp3',
+                    'preferredquality': AUDIO_MP3_BITRATE,
+                }]
+            elif output_format != 'native':
+                # FFmpegExtractAudio stream-copies when the source codec already matches
+                ydl_opts['postprocessors'] = [{
+                    'key': 'FFmpegExtractAudio',
+                    'preferredcodec': output_format,
+                }]
+            
+            return ydl_opts
         else:  # video
             quality_format = VIDEO_QUALITY_PRESETS.get(quality, VIDEO_QUALITY_PRESETS['1080p'])
+            if format_id:
+                quality_format = f"{format_id}/{quality_format}"
             
             # Enhanced video options for high quality
             ydl_opts = {
                 'format': quality_format,
-                'outtmpl': os.path.join(self.download_path, output_template),
+                'outtmpl': os.path.join(output_dir, output_template),
+                # Keep resolution first, then prefer codecs that fit in mp4 without re-encoding
+                'format_sort': ['res', 'vcodec:h264', 'acodec:aac'],
+                # Merging separate video and audio streams is a stream copy
+                'merge_output_format': 'mp4',
+                # Single-file downloads in another container are remuxed, never transcoded
+                'postprocessors': [{
+                    'key': 'FFmpegVideoRemuxer',
+                    'preferedformat': 'mp4',
+                }],
                 'writesubtitles': False,
                 'writeautomaticsub': False,
                 'ignoreerrors': True,
@@ -45,70 +239,200 @@ class YouTubeDownloader:
                 'quiet': True,
             }
             
-            # Add merge options for high-quality video+audio
-            if quality in ['4k', '2k', '1080p']:
-                ydl_opts['merge_output_format'] = 'mp4'
-                ydl_opts['postprocessors'] = [{
-                    'key': 'FFmpegVideoConvertor',
-                    'preferedformat': 'mp4',
-                }]
-            
             return ydl_opts
     
+    def _get_info_opts(self, playlist_items: str = None) -> Dict:
+        """Get yt-dlp options for metadata extraction.
+
+        Playlists are listed flat (IDs and titles only); entries are resolved
+        one by one with get_video_info just before they are downloaded.
+        """
+        return {
+            'quiet': True,
+            'extract_flat': 'in_playlist',
+            'playlist_items': playlist_items or f"1-{MAX_PLAYLIST_ITEMS}",
+        }
+    
     async def get_video_info(self, url: str) -> Optional[Dict]:
-        """Get video information without downloading"""
+        """Get video information without downloading (read through the metadata cache).
+
+        For playlists only the first MAX_PLAYLIST_ITEMS entries are listed, flat;
+        'playlist_count' holds the full size when YouTube reports it.
+        """
+        key = canonical_key(url)
+        info = self.metadata_cache.get(key)
+        if info is not None:
+            return info
+        return await self._extract_into_cache(url, key)
+    
+    async def _extract_into_cache(self, url: str, key: str) -> Optional[Dict]:
+        """Extract a URL's information after a cache miss on key and cache it there"""
         try:
-            with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-                info = ydl.extract_info(url, download=False)
-                return info
+            info, seconds = await self.extract_pool.run(_timed, _extract_info, url, self._get_info_opts())
+            record_stage('extract', seconds)
+            if info:
+                self.metadata_cache.set(key, info)
+            return info
+        except WorkerPoolFullError:
+            raise
         except Exception as e:
             logger.error(f"Error getting video info: {e}")
             return None
     
+    async def resolve_entry(self, entry: Dict) -> Optional[Dict]:
+        """Resolve a flat playlist entry into full video information"""
+        if entry.get('formats'):
+            return entry
+        
+        key = video_key(entry['id']) if entry.get('id') else None
+        if key:
+            info = self.metadata_cache.get(key)
+            if info is not None:
+                return info
+        
+        entry_url = entry.get('url') or entry.get('webpage_url')
+        if not entry_url and key:
+            entry_url = f"https://www.youtube.com/watch?v={entry['id']}"
+        if not entry_url:
+            return None
+        
+        if key and canonical_key(entry_url) == key:
+            return await self._extract_into_cache(entry_url, key)  # Already counted as a miss
+        return await self.get_video_info(entry_url)
+    
+    async def iter_playlist_pages(self, url: str, page_size: int = None, max_items: int = None) -> AsyncIterator[List[Dict]]:
+        """Yield flat playlist entries page by page, listing each page only when it's needed"""
+        if page_size is None:
+            page_size = PLAYLIST_PAGE_SIZE
+        if max_items is None:
+            max_items = MAX_PLAYLIST_ITEMS
+        
+        key = canonical_key(url)
+        start = 1
+        while start <= max_items:
+            end = min(start + page_size - 1, max_items)
+            # The default first page is exactly what get_video_info lists
+            page_key = key if (start, end) == (1, MAX_PLAYLIST_ITEMS) else f"{key}#{start}-{end}"
+            
+            info = self.metadata_cache.get(page_key)
+            if info is None:
+                try:
+                    info, seconds = await self.extract_pool.run(_timed, _extract_info, url, self._get_info_opts(f"{start}-{end}"))
+                    record_stage('extract', seconds)
+                except WorkerPoolFullError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Error listing playlist page {start}-{end}: {e}")
+                    return
+                if not info or 'entries' not in info:
+                    return
+                self.metadata_cache.set(page_key, info)
+            
+            entries = [entry for entry in info['entries'] if entry]
+            if entries:
+                yield entries
+            
+            # A short page means the playlist ran out
+            if len(info['entries']) < end - start + 1:
+                return
+            start = end + 1
+    
+    async def get_format_index(self, url: str) -> Optional[Dict]:
+        """Get the compact format index of a video, built once from the cached probe.
+
+        For playlists the first entry stands in for the whole list.
+        """
+        key = f"{canonical_key(url)}#formats"
+        index = self.metadata_cache.get(key)
+        if index is not None:
+            return index
+        
+        info = await self.get_video_info(url)
+        if not info:
+            return None
+        
+        if 'entries' in info:
+            if not info['entries']:
+                return None
+            info = await self.resolve_entry(info['entries'][0])
+            if not info:
+                return None
+        
+        index = build_format_index(info)
+        self.metadata_cache.set(key, index)
+        return index
+    
+    def _size_estimator(self, index: Dict, download_type: str) -> Callable[[Dict], Optional[int]]:
+        """Estimate the delivered file size of a format selection"""
+        def estimate(selection: Dict) -> Optional[int]:
+            if download_type == 'audio' and AUDIO_OUTPUT_FORMAT == 'mp3' and index['duration']:
+                # Transcoded at a fixed bitrate, whatever the source was
+                return int(int(AUDIO_MP3_BITRATE) * 1000 / 8 * index['duration'])
+            return selection['filesize']
+        return estimate
+    
+    def select_format(self, index: Dict, download_type: str, quality: str,
+                      max_filesize: Optional[int] = None) -> Optional[Tuple[str, Dict]]:
+        """Pick exact formats for a quality preset, stepping down until the estimated size fits.
+
+        Returns (quality, selection) or None if nothing fits in max_filesize.
+        """
+        preferred_acodec = None
+        if download_type == 'audio':
+            preferred_acodec = AUDIO_SOURCE_CODECS.get(AUDIO_OUTPUT_FORMAT)
+        return select_format_within(index, download_type, quality, max_filesize,
+                                    self._size_estimator(index, download_type), preferred_acodec=preferred_acodec)
+    
+    async def estimate_sizes(self, url: str, download_type: str) -> Dict[str, Optional[int]]:
+        """Estimated size in bytes of each available quality, None where unknown"""
+        index = await self.get_format_index(url)
+        if not index:
+            return {}
+        
+        sizes = {}
+        for quality in available_qualities(index, download_type):
+            selected = self.select_format(index, download_type, quality)
+            if selected:
+                sizes[quality] = selected[1]['filesize']
+        return sizes
+    
+    async def fit_quality(self, url: str, download_type: str, quality: str) -> Optional[str]:
+        """The requested quality if it fits the upload limit, else the best smaller one (None if none does)"""
+        index = await self.get_format_index(url)
+        if not index:
+            return quality  # Nothing to estimate from; let the download decide
+        
+        selected = self.select_format(index, download_type, quality, self.upload_limit)
+        return selected[0] if selected else None
+    
     async def get_available_video_formats(self, url: str) -> Dict:
-        """Get detailed information about available video formats"""
+        """Get detailed information about available video formats, grouped by height"""
         try:
-            with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-                info = ydl.extract_info(url, download=False)
-                
-                if 'entries' in info:
-                    # It's a playlist, get info from first video
-                    if info['entries']:
-                        info = info['entries'][0]
-                    else:
-                        return {}
-                
-                formats = info.get('formats', [])
-                video_formats = {}
-                
-                for fmt in formats:
-                    if fmt.get('vcodec') != 'none' and fmt.get('height'):
-                        height = fmt.get('height', 0)
-                        ext = fmt.get('ext', 'unknown')
-                        filesize = fmt.get('filesize', 0)
-                        fps = fmt.get('fps', 0)
-                        
-                        if height not in video_formats:
-                            video_formats[height] = []
-                        
-                        video_formats[height].append({
-                            'ext': ext,
-                            'filesize': filesize,
-                            'fps': fps,
-                            'format_id': fmt.get('format_id', ''),
-                            'url': fmt.get('url', ''),
-                            'vcodec': fmt.get('vcodec', ''),
-                            'acodec': fmt.get('acodec', '')
-                        })
-                
-                return video_formats
-                
+            index = await self.get_format_index(url)
+            if not index:
+                return {}
+            
+            video_formats = {}
+            for fmt in index['video']:
+                video_formats.setdefault(fmt['height'], []).append(fmt)
+            return video_formats
+            
+        except WorkerPoolFullError:
+            raise
         except Exception as e:
             logger.error(f"Error getting video formats: {e}")
             return {}
     
-    async def download_single_video(self, url: str, download_type: str = 'audio', quality: str = 'best') -> Optional[str]:
-        """Download a single video as audio or video"""
+    async def download_single_video(self, url: str, download_type: str = 'audio', quality: str = 'best', owner: Optional[int] = None,
+                                    fit_upload_limit: bool = True,
+                                    progress: Optional[DownloadProgress] = None) -> Optional[Tuple[str, str]]:
+        """Download a single video as audio or video and return (file path, quality downloaded).
+
+        The quality is lower than the requested one if that doesn't fit the
+        upload limit. With fit_upload_limit=False the requested quality is kept
+        even if the result has to be split into parts for upload. progress
+        receives live updates from yt-dlp.
+        """
         try:
             # Get video info first
             info = await self.get_video_info(url)
@@ -120,154 +444,185 @@ class YouTubeDownloader:
                 logger.warning("URL contains playlist, use download_playlist instead")
                 return None
             
-            # Create output template with safe filename
-            safe_title = "".join(c for c in info.get('title', 'video') if c.isalnum() or c in (' ', '-', '_')).rstrip()
+            # Download from the cached info so yt-dlp doesn't extract the URL again
+            return await self._download_in_job_dir(info, download_type, quality, info.get('id', 'video'), owner, fit_upload_limit,
+                                                   progress)
             
-            if download_type == 'audio':
-                output_template = f"{safe_title}.%(ext)s"
-                expected_extension = '.mp3'
+        except (WorkerPoolFullError, StorageFullError, FileTooLargeError):
+            raise
+        except Exception as e:
+            logger.error(f"Error downloading video: {e}")
+            return None
+    
+    async def _download_in_job_dir(self, info: Dict, download_type: str, quality: str, job_name: str, owner: Optional[int] = None,
+                                   fit_upload_limit: bool = True,
+                                   progress: Optional[DownloadProgress] = None) -> Optional[Tuple[str, str]]:
+        """Download into a fresh work directory for this job and return (final file path, quality downloaded)"""
+        # Choose formats before touching the disk, so nothing is downloaded that can't be uploaded
+        index = build_format_index(info)
+        selected = self.select_format(index, download_type, quality, self.upload_limit if fit_upload_limit else None)
+        if selected is None and (index['video'] or index['audio']):
+            if not SPLIT_OVERSIZED:
+                raise FileTooLargeError(
+                    f"{info.get('id')} is larger than {self.upload_limit // (1024 * 1024)} MB in every {download_type} quality"
+                )
+            # Too large in every quality: download what was asked for and deliver it in parts
+            selected = self.select_format(index, download_type, quality)
+        if selected and selected[0] != quality:
+            logger.info(f"Using {selected[0]} instead of {quality} for {info.get('id')} to stay under the upload limit")
+        
+        # Checking the quota walks the download path and may sweep it, so it stays off the event loop
+        creating = asyncio.get_running_loop().run_in_executor(None, self.storage.create_job_dir, job_name, owner)
+        try:
+            job_dir = await asyncio.shield(creating)
+        except asyncio.CancelledError:
+            # The directory is pinned until removed, so it mustn't be forgotten halfway
+            creating.add_done_callback(lambda f: f.exception() or self.storage.remove(f.result()))
+            raise
+        ydl_opts = self._get_ydl_opts(download_type, selected[0] if selected else quality, output_dir=job_dir,
+                                      format_id=selected[1]['format_id'] if selected else None)
+        
+        try:
+            # Hooks running in another process can't report back, so progress needs a thread pool;
+            # there only the cancellation is passed on
+            if self.download_pool.kind != 'thread':
+                cancel = CancelFlag(os.path.join(job_dir, CANCEL_FILE))
+                stop, hooks = cancel.set, cancel
             else:
-                output_template = f"{safe_title}.%(ext)s"
-                expected_extension = '.mp4'
-            
-            ydl_opts = self._get_ydl_opts(download_type, quality, output_template)
-            
-            # Download the video
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
+                progress = progress or DownloadProgress()  # Still needed to stop the download on cancel
+                stop, hooks = progress.cancel, progress
+            file_path, timings = await self._run_download(stop, _download_info, copy.deepcopy(info), ydl_opts, hooks)
+        except BaseException:
+            self.storage.remove(job_dir)
+            raise
+        
+        for stage, seconds in timings.items():
+            record_stage(stage, seconds)
+        if not file_path or not os.path.exists(file_path):
+            self.storage.remove(job_dir)
+            return None
+        
+        BYTES.inc(os.path.getsize(file_path), direction='download')
+        self.storage.mark_ready(job_dir)
+        return file_path, selected[0] if selected else quality
+    
+    async def _run_download(self, stop: Optional[Callable[[], None]], func: Callable, *args, **kwargs):
+        """Run blocking work in the download pool, stopping it if the caller is cancelled.
+
+        Cancelled while waiting for a worker, it simply gives up its place. Once
+        the work has started, stop() is called and the work is awaited until it
+        has actually returned, so its files are no longer being written by the
+        time the caller removes them.
+        """
+        async with self.download_pool.slot():
+            future = self.download_pool.submit(func, *args, **kwargs)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if stop:
+                    stop()
+                await asyncio.gather(future, return_exceptions=True)
+                raise
+    
+    async def _download_playlist_item(self, index: int, entry: Dict, download_type: str, quality: str, owner: Optional[int] = None,
+                                      progress: Optional[DownloadProgress] = None) -> Optional[Tuple[str, str]]:
+        """Resolve and download one playlist entry into (file path, quality); returns None if it fails"""
+        try:
+            entry_info = await self.resolve_entry(entry)
+            if not entry_info:
+                logger.error(f"Could not resolve playlist item {index+1}")
+                return None
             
-            # Find the downloaded file
-            for file in os.listdir(self.download_path):
-                if file.startswith(safe_title) and file.endswith(expected_extension):
-                    file_path = os.path.join(self.download_path, file)
-                    return file_path
+            job_name = f"{index+1:02d}-{entry_info.get('id', 'video')}"
+            return await self._download_in_job_dir(entry_info, download_type, quality, job_name, owner, progress=progress)
             
+        except FileTooLargeError as e:
+            logger.warning(f"Skipping playlist item {index+1}: {e}")
             return None
-            
+        except (WorkerPoolFullError, StorageFullError):
+            raise
         except Exception as e:
-            logger.error(f"Error downloading video: {e}")
+            logger.error(f"Error downloading playlist item {index+1}: {e}")
             return None
     
-    async def download_playlist(self, url: str, download_type: str = 'audio', quality: str = 'best', max_items: int = None) -> List[str]:
-        """Download multiple videos from a playlist"""
+    async def iter_playlist_downloads(self, url: str, download_type: str = 'audio', quality: str = 'best', max_items: int = None,
+                                      should_download: Optional[Callable[[Dict], bool]] = None, owner: Optional[int] = None,
+                                      progress: Optional[DownloadProgress] = None
+                                      ) -> AsyncIterator[Tuple[int, Dict, Optional[Tuple[str, str]]]]:
+        """Download playlist items and yield (index, entry, download) in playlist order as each one finishes.
+
+        download is (file path, quality downloaded), as from download_single_video.
+        Only PLAYLIST_CONCURRENCY items are downloaded ahead of the consumer, so
+        sending item N overlaps with downloading the next ones while disk use
+        stays bounded. download is None for items that failed, and for items
+        skipped because should_download(entry) returned False.
+        """
+        if max_items is None:
+            max_items = MAX_PLAYLIST_ITEMS
+        
+        window = max(1, PLAYLIST_CONCURRENCY)
+        in_flight = deque()
+        index = 0
+        
         try:
-            if max_items is None:
-                max_items = MAX_PLAYLIST_ITEMS
-            
-            # Get playlist info
-            info = await self.get_video_info(url)
-            if not info or 'entries' not in info:
-                logger.error("URL is not a playlist")
-                return []
+            # List entries flat; each one is resolved just before it downloads
+            async for page in self.iter_playlist_pages(url, max_items=max_items):
+                for entry in page:
+                    task = None
+                    if should_download is None or should_download(entry):
+                        task = asyncio.ensure_future(self._download_playlist_item(index, entry, download_type, quality, owner, progress))
+                    in_flight.append((index, entry, task))
+                    index += 1
+                    
+                    if len(in_flight) >= window:
+                        item_index, item_entry, task = in_flight.popleft()
+                        yield item_index, item_entry, (await task if task else None)
             
-            entries = info['entries'][:max_items]
+            while in_flight:
+                item_index, item_entry, task = in_flight.popleft()
+                yield item_index, item_entry, (await task if task else None)
+        finally:
+            # The consumer stopped early or something failed: drop what's left,
+            # including items that finished downloading but were never taken
+            tasks = [task for _, _, task in in_flight if task]
+            for task in tasks:
+                task.cancel()
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, tuple):
+                    self.remove_download(result[0])
+    
+    async def download_playlist(self, url: str, download_type: str = 'audio', quality: str = 'best', max_items: int = None, owner: Optional[int] = None) -> List[str]:
+        """Download multiple videos from a playlist and return all file paths in playlist order"""
+        try:
             downloaded_files = []
+            async for _, _, download in self.iter_playlist_downloads(url, download_type, quality, max_items, owner=owner):
+                if download:
+                    downloaded_files.append(download[0])
             
-            for i, entry in enumerate(entries):
-                if not entry:
-                    continue
-                
-                try:
-                    video_url = entry.get('url') or entry.get('webpage_url')
-                    if not video_url:
-                        continue
-                    
-                    # Create output template with index and safe filename
-                    safe_title = "".join(c for c in entry.get('title', f'video_{i+1}') if c.isalnum() or c in (' ', '-', '_')).rstrip()
-                    
-                    if download_type == 'audio':
-                        output_template = f"{i+1:02d}_{safe_title}.%(ext)s"
-                        expected_extension = '.mp3'
-                    else:
-                        output_template = f"{i+1:02d}_{safe_title}.%(ext)s"
-                        expected_extension = '.mp4'
-                    
-                    ydl_opts = self._get_ydl_opts(download_type, quality, output_template)
-                    
-                    # Download the video
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        ydl.download([video_url])
-                    
-                    # Find the downloaded file
-                    for file in os.listdir(self.download_path):
-                        if file.startswith(f"{i+1:02d}_{safe_title}") and file.endswith(expected_extension):
-                            file_path = os.path.join(self.download_path, file)
-                            downloaded_files.append(file_path)
-                    
-                    # Small delay to avoid overwhelming the server
-                    await asyncio.sleep(1)
-                    
-                except Exception as e:
-                    logger.error(f"Error downloading playlist item {i+1}: {e}")
-                    continue
-            
+            if not downloaded_files:
+                logger.error("No playlist items were downloaded")
             return downloaded_files
             
+        except (WorkerPoolFullError, StorageFullError):
+            raise
         except Exception as e:
             logger.error(f"Error downloading playlist: {e}")
             return []
     
     async def get_available_qualities(self, url: str, download_type: str = 'audio') -> List[str]:
-        """Get available quality options for a video"""
+        """Get the quality presets a video actually offers, best first"""
         try:
-            with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-                info = ydl.extract_info(url, download=False)
-                
-                if 'entries' in info:
-                    # It's a playlist, get info from first video
-                    if info['entries']:
-                        info = info['entries'][0]
-                    else:
-                        return []
-                
-                if download_type == 'audio':
-                    formats = info.get('formats', [])
-                    audio_formats = [f for f in formats if f.get('acodec') != 'none']
-                    
-                    qualities = []
-                    for fmt in audio_formats:
-                        abr = fmt.get('abr', 0)
-                        if abr > 0:
-                            if abr >= 192:
-                                qualities.append('best')
-                            elif abr >= 128:
-                                qualities.append('high')
-                            elif abr >= 64:
-                                qualities.append('medium')
-                            else:
-                                qualities.append('low')
-                else:  # video
-                    formats = info.get('formats', [])
-                    video_formats = [f for f in formats if f.get('vcodec') != 'none']
-                    
-                    qualities = []
-                    available_heights = set()
-                    
-                    for fmt in video_formats:
-                        height = fmt.get('height', 0)
-                        if height > 0:
-                            available_heights.add(height)
-                    
-                    # Map available heights to quality options
-                    if any(h >= 2160 for h in available_heights):
-                        qualities.append('4k')
-                    if any(h >= 1440 for h in available_heights):
-                        qualities.append('2k')
-                    if any(h >= 1080 for h in available_heights):
-                        qualities.append('1080p')
-                    if any(h >= 720 for h in available_heights):
-                        qualities.append('720p')
-                    if any(h >= 480 for h in available_heights):
-                        qualities.append('480p')
-                    if any(h >= 360 for h in available_heights):
-                        qualities.append('360p')
-                    
-                    # If no specific heights found, use fallback
-                    if not qualities:
-                        qualities = ['1080p', '720p', '480p', '360p']
-                
-                return list(set(qualities))  # Remove duplicates
-                
+            index = await self.get_format_index(url)
+            if index is None:
+                raise ValueError("No video information returned")
+            
+            qualities = available_qualities(index, download_type)
+            if not qualities and download_type == 'video':
+                qualities = ['1080p', '720p', '480p', '360p']  # No heights reported; let the presets decide
+            return qualities
+            
+        except WorkerPoolFullError:
+            raise
         except Exception as e:
             logger.error(f"Error getting available qualities: {e}")
             if download_type == 'audio':
@@ -275,13 +630,46 @@ class YouTubeDownloader:
             else:
                 return ['4k', '2k', '1080p', '720p', '480p', '360p']  # Fallback to default video qualities
     
-    def cleanup_downloads(self):
-        """Clean up downloaded files"""
+    async def split_for_upload(self, file_path: str) -> List[str]:
+        """Split a file larger than the upload limit into stream-copied parts, in order"""
+        if self.download_pool.kind != 'thread':
+            stop = CancelFlag(os.path.join(os.path.dirname(file_path), CANCEL_FILE))
+        else:
+            stop = threading.Event()
+        parts, seconds = await self._run_download(stop.set, _timed, split_media, file_path, self.upload_limit,
+                                                  should_stop=stop.is_set)
+        record_stage('split', seconds)
+        return parts
+    
+    async def preload(self):
+        """Load yt-dlp in the background once the bot is up, so the first URL doesn't wait for it"""
+        try:
+            await self.extract_pool.run(_preload)
+        except Exception as e:
+            logger.error(f"Could not load yt-dlp: {e}")
+
+    def shutdown(self):
+        """Release the worker pools"""
+        self.extract_pool.shutdown(wait=False)
+        self.download_pool.shutdown(wait=False)
+        _ydl_pool.close()
+    
+    def remove_download(self, file_path: str):
+        """Delete a delivered download together with its job directory"""
+        self.storage.remove(file_path)
+    
+    async def cleanup_downloads(self, owner: Optional[int] = None) -> int:
+        """Remove crash leftovers; jobs still downloading or being delivered are kept.
+
+        With owner set only that user's leftovers are removed.
+        """
         try:
-            for file in os.listdir(self.download_path):
-                file_path = os.path.join(self.download_path, file)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
+            # Walks the download path and waits for any background sweep, so it stays off the event loop
+            removed = await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self.storage.collect_garbage, force=True, owner=owner)
+            )
             logger.info("Download directory cleaned up")
+            return removed
         except Exception as e:
             logger.error(f"Error cleaning up downloads: {e}")
+            return 0